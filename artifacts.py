@@ -0,0 +1,259 @@
+'''Content-addressed store of compressed artifacts (binaries) sent to hosts.
+
+Every file is compressed once per version and kept under ARTIFACTS_DIR, named by the sha256 of its
+contents. Uploads compare the hash with the one of the remote copy, so hosts that already have
+the exact version are skipped.
+
+seed_artifact sends a file to a whole region while uploading it from here only once: a seed host
+gets it first and copies it to the other hosts of the region over their private ips. The seed logs in
+to them with a one-time key pair, authorized only on those hosts and only for connections from the seed.
+'''
+
+import hashlib
+import os
+import shlex
+import tempfile
+import uuid
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+from subprocess import run
+from time import time
+
+from dispatch import connection
+from tracing import record
+from transfer import send_stream
+from utils import file_lock, read_json, write_json_atomic
+
+ARTIFACTS_DIR = 'bin/.artifacts'
+ARTIFACTS_INDEX = os.path.join(ARTIFACTS_DIR, 'index.json')
+# zstd level; archives are built once per version, so it pays off to compress harder than transfers do
+ARTIFACT_COMPRESSION = 12
+# number of hosts a seed copies an artifact to at once
+SEED_FANOUT = 8
+# path of the one-time key on a seed host, it is removed when seeding finishes
+SEED_KEY_PATH = '.ssh/seed_key'
+
+Artifact = namedtuple('Artifact', ['path', 'sha256', 'archive', 'mode'])
+# one copy of an artifact: src is 'local' for uploads from this machine, bytes are compressed bytes sent
+Hop = namedtuple('Hop', ['region', 'src', 'dst', 'bytes', 'start', 'end', 'ok'])
+
+# path --> (size, mtime, Artifact) of artifacts used by this process
+_artifacts = {}
+_artifacts_lock = Lock()
+
+
+def sha256_of(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def artifact(path):
+    '''
+    Returns the artifact of a local file, compressing the file if its current version was not
+    compressed yet. Safe to call from many threads and processes at once, the file is hashed and
+    compressed by only one of them.
+    '''
+
+    stat = os.stat(path)
+    with _artifacts_lock:
+        cached = _artifacts.get(path)
+    if cached is not None and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    os.makedirs(ARTIFACTS_DIR, exist_ok=True)
+    with file_lock(ARTIFACTS_INDEX):
+        index = read_json(ARTIFACTS_INDEX, {})
+        entry = index.get(path)
+        if entry is None or (entry['size'], entry['mtime']) != (stat.st_size, stat.st_mtime_ns):
+            entry = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': sha256_of(path)}
+        archive = os.path.join(ARTIFACTS_DIR, entry['sha256'] + '.zst')
+        if not os.path.exists(archive):
+            run(['zstd', '-q', '-f', f'-{ARTIFACT_COMPRESSION}', '-T0', path, '-o', archive + '.tmp'], check=True)
+            os.replace(archive + '.tmp', archive)
+
+        previous = index.get(path, {}).get('sha256')
+        index[path] = entry
+        write_json_atomic(ARTIFACTS_INDEX, index)
+        # drop the archive of the previous version unless another file still has the same contents
+        if previous not in (None, entry['sha256']) and all(e['sha256'] != previous for e in index.values()):
+            os.remove(os.path.join(ARTIFACTS_DIR, previous + '.zst'))
+
+    result = Artifact(path, entry['sha256'], archive, stat.st_mode & 0o777)
+    with _artifacts_lock:
+        _artifacts[path] = (stat.st_size, stat.st_mtime_ns, result)
+
+    return result
+
+
+def remote_sha256(conn, remote_path):
+    ''' Returns the sha256 of a file on a host, None if the file does not exist.'''
+
+    res = conn.run(f'sha256sum {remote_path}', hide='both', warn=True)
+    return res.stdout.split()[0] if res.ok and res.stdout else None
+
+
+def send_artifact(conn, path, remote_path=None):
+    '''
+    Sends a local file to a host unless the host already has the same version of it. The archive
+    is streamed over one ssh channel and unpacked on the fly, the file replaces the remote copy atomically.
+    :param string remote_path: path on the host, the name of the local file in the home directory by default
+    :returns: True if the file was sent, False if it was up to date
+    '''
+
+    remote_path = remote_path or os.path.basename(path)
+    art = artifact(path)
+    if remote_sha256(conn, remote_path) == art.sha256:
+        return False
+
+    _upload(conn, art, remote_path)
+
+    return True
+
+
+def _remote_archive(art, remote_path):
+    return f'{remote_path}.{art.sha256[:16]}.zst'
+
+
+def _install_cmd(art, remote_path):
+    ''' Remote command unpacking an archive read from stdin, verifying the file and moving it into place atomically.'''
+
+    return (f'zstd -q -dc > {remote_path}.part'
+            f' && echo "{art.sha256}  {remote_path}.part" | sha256sum -c --quiet'
+            f' && chmod {art.mode:o} {remote_path}.part && mv {remote_path}.part {remote_path}')
+
+
+def _upload(conn, art, remote_path, keep_archive=None):
+    ''' Streams the archive of an artifact to a host, keeping a copy of it at keep_archive if given.'''
+
+    cmd = _install_cmd(art, remote_path)
+    if keep_archive is not None:
+        cmd = f'tee {keep_archive} | {cmd}'
+    with open(art.archive, 'rb') as f:
+        return send_stream(conn, f, cmd)
+
+
+def seed_artifact(path, hosts, remote_path=None, region=None, fanout=SEED_FANOUT):
+    '''
+    Sends a local file to all given hosts of one region, uploading it from here at most once.
+    A seed host (one that already has the file, otherwise the first host) receives the archive,
+    then streams it over ssh to the other hosts over the private network, fanout of them at once.
+    For that time the seed gets a one-time key, see _authorize_seed. Hosts that already have the file are skipped.
+    :param list hosts: pairs (public ip, private ip) of hosts in the same region
+    :returns: list of Hop, one per copy that was made
+    '''
+
+    remote_path = remote_path or os.path.basename(path)
+    art = artifact(path)
+    remote_archive = _remote_archive(art, remote_path)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(len(hosts), fanout * 4))) as pool:
+        shas = list(pool.map(lambda host: remote_sha256(connection(host[0]), remote_path), hosts))
+    todo = [host for host, sha in zip(hosts, shas) if sha != art.sha256]
+    if not todo:
+        return []
+    up_to_date = [host for host, sha in zip(hosts, shas) if sha == art.sha256]
+
+    hops = []
+    if up_to_date:
+        seed = up_to_date[0]
+        seed_conn = connection(seed[0])
+        seed_conn.run(f'zstd -q -f -1 {remote_path} -o {remote_archive}', hide='both')
+    else:
+        seed, todo = todo[0], todo[1:]
+        seed_conn = connection(seed[0])
+        start = time()
+        try:
+            _upload(seed_conn, art, remote_path, keep_archive=remote_archive)
+        except Exception:
+            hops.append(_hop(region, 'local', seed[0], os.path.getsize(art.archive), start, False))
+            raise
+        hops.append(_hop(region, 'local', seed[0], os.path.getsize(art.archive), start, True))
+    if not todo:
+        seed_conn.run(f'rm -f {remote_archive}', hide='both')
+        return hops
+
+    size = int(seed_conn.run(f'stat -c %s {remote_archive}', hide='both').stdout)
+
+    def copy(host):
+        start = time()
+        try:
+            seed_conn.run(f'ssh -o StrictHostKeyChecking=no -o UserKnownHostsFile=/dev/null -i {SEED_KEY_PATH} '
+                          f'ubuntu@{host[1]} {shlex.quote(_install_cmd(art, remote_path))} < {remote_archive}',
+                          hide='both')
+            return _hop(region, seed[0], host[0], size, start, True)
+        except Exception as e:
+            print(f'copying {remote_path} from {seed[0]} to {host[0]} failed: {type(e).__name__}: {e}')
+            return _hop(region, seed[0], host[0], size, start, False)
+
+    marker = f'aleph-seed-{uuid.uuid4().hex}'
+    try:
+        _authorize_seed(seed_conn, seed[1], todo, marker, fanout)
+        with ThreadPoolExecutor(max_workers=fanout) as pool:
+            hops += list(pool.map(copy, todo))
+    finally:
+        seed_conn.run(f'rm -f {SEED_KEY_PATH} {remote_archive}', hide='both', warn=True)
+        with ThreadPoolExecutor(max_workers=fanout * 4) as pool:
+            list(pool.map(lambda host: connection(host[0]).run(
+                f'sed -i "/ {marker}$/d" .ssh/authorized_keys', hide='both', warn=True), todo))
+
+    return hops
+
+
+def _authorize_seed(seed_conn, seed_ip, hosts, marker, fanout=SEED_FANOUT):
+    '''
+    Creates a one-time key pair, authorizes it on given hosts and puts its private part on the seed.
+    The key is accepted only from the private ip of the seed and only for running commands, so even
+    if cleanup fails it grants nothing beyond these hosts.
+    :param string marker: comment of the key in authorized_keys, lines with it are removed after seeding
+    '''
+
+    with tempfile.TemporaryDirectory() as tmp:
+        key = os.path.join(tmp, 'key')
+        run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-C', marker, '-f', key], check=True)
+        with open(key + '.pub', 'r') as f:
+            public = f.read().strip()
+        options = f'from="{seed_ip}",no-port-forwarding,no-agent-forwarding,no-X11-forwarding,no-pty'
+        line = shlex.quote(f'{options} {public}')
+        with ThreadPoolExecutor(max_workers=max(1, min(len(hosts), fanout * 4))) as pool:
+            list(pool.map(lambda host: connection(host[0]).run(
+                f'echo {line} >> .ssh/authorized_keys', hide='both'), hosts))
+        seed_conn.put(key, SEED_KEY_PATH)
+    seed_conn.run(f'chmod 600 {SEED_KEY_PATH}', hide='both')
+
+
+def _hop(region, src, dst, size, start, ok):
+    hop = Hop(region, src, dst, size, start, time(), ok)
+    record('copy', hop.start, hop.end, 'artifact', track=dst, src=src, bytes=size,
+           mbps=round(_throughput(hop), 2))
+
+    return hop
+
+
+def _throughput(hop):
+    ''' Throughput of a hop in MB/s.'''
+
+    return hop.bytes / 1e6 / max(hop.end - hop.start, 1e-6)
+
+
+def print_hops(hops):
+    ''' Prints throughput of uploads to seeds and of copies within every region.'''
+
+    for region in sorted({hop.region for hop in hops}, key=str):
+        in_region = [hop for hop in hops if hop.region == region]
+        for label, group in [('upload', [h for h in in_region if h.src == 'local']),
+                             ('in region', [h for h in in_region if h.src != 'local'])]:
+            done = sorted(_throughput(h) for h in group if h.ok)
+            if not group:
+                continue
+            failed = len(group) - len(done)
+            if not done:
+                print(f'{str(region):16} {label:10} hosts {len(group):4}  failed {failed:4}')
+                continue
+            span = max(h.end for h in group) - min(h.start for h in group)
+            print(f'{str(region):16} {label:10} hosts {len(group):4}  failed {failed:4}  MB/s min {done[0]:8.2f}'
+                  f'  p50 {done[len(done) // 2]:8.2f}  max {done[-1]:8.2f}  took {span:.2f}s')
@@ -0,0 +1,65 @@
+'''Measures cold import time of the orchestration modules.
+
+Every sample imports a module in a fresh interpreter, so nothing is cached in sys.modules.
+Run from the repository root: python benchmarks/import_time.py [-n RUNS] [--json] [modules...]
+'''
+
+import argparse
+import json
+import os
+import statistics
+import sys
+from subprocess import run
+
+MODULES = ['shell', 'utils', 'fabfile']
+
+SNIPPET = '''
+from time import perf_counter
+start = perf_counter()
+import {module}
+print(perf_counter() - start)
+'''
+
+
+def import_time(module, cwd):
+    ''' Returns the time in seconds it takes to import a module in a fresh interpreter.'''
+
+    res = run([sys.executable, '-c', SNIPPET.format(module=module)],
+              cwd=cwd, capture_output=True, text=True)
+    if res.returncode != 0:
+        raise RuntimeError(f'importing {module} failed:\n{res.stderr}')
+
+    return float(res.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('modules', nargs='*', default=MODULES)
+    parser.add_argument('-n', '--runs', type=int, default=10)
+    parser.add_argument('--json', action='store_true', help='print one json object per module')
+    args = parser.parse_args()
+
+    cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    for module in args.modules:
+        try:
+            samples = [import_time(module, cwd) for _ in range(args.runs)]
+        except RuntimeError as e:
+            print(e, file=sys.stderr)
+            continue
+
+        stats = {
+            'module': module,
+            'runs': args.runs,
+            'min_ms': round(1000 * min(samples), 2),
+            'median_ms': round(1000 * statistics.median(samples), 2),
+            'max_ms': round(1000 * max(samples), 2),
+        }
+        if args.json:
+            print(json.dumps(stats))
+        else:
+            print(f"{module:10} min {stats['min_ms']:8.2f}ms  median {stats['median_ms']:8.2f}ms  "
+                  f"max {stats['max_ms']:8.2f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,200 @@
+'''Per-pid bundles: everything a node needs that is specific to it, packed once before dispatch.
+
+A bundle of a pid is a tar+zstd archive with data/{auth} (keys and the p2p secret) and, if asked
+for, the dispatch scripts cmd.sh and download_run_cmd.sh. Bundles are built locally in a process
+pool, so send-data only streams a ready archive to every host. The chainspec is the same for all
+nodes and is sent as an artifact instead (see artifacts.py).
+'''
+
+import json
+import os
+import shutil
+import tempfile
+from datetime import date, timedelta
+from itertools import chain
+from subprocess import run
+
+from transfer import TRANSFER_COMPRESSION
+
+BUNDLES_DIR = 'bundles'
+BUNDLE_JOBS = -1
+
+DB_SNAPSHOT_HOST = 'https://db.test.azero.dev'
+# a relay host serves the snapshot of its region over http on this port
+DB_RELAY_PORT = 8080
+DB_RELAY_DIR = 'db_relay'
+
+
+def bundle_path(pid):
+    return os.path.join(BUNDLES_DIR, f'{pid}.tar.zst')
+
+
+def _lines(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f.readlines()]
+
+
+def get_node_flags(auth, bootnodes, addr, custom_flags=None):
+    '''
+    Returns flags of the node of a given validator.
+    :param dict custom_flags: flags overriding the default ones, read from node_flags.json by default
+    '''
+
+    no_val_flags = [
+        '--validator',
+        '--prometheus-external',
+        '--no-telemetry',
+        '--unsafe-ws-external',
+        '--unsafe-rpc-external',
+    ]
+    debug_flags = [
+        '-laleph-network=debug',
+        '-laleph-party=debug',
+        '-lAlephBFT-creator=debug',
+    ]
+    val_flags = {
+        '--chain': 'chainspec.json',
+        '--base-path': f'data/{auth}',
+        '--rpc-port': '9933',
+        '--ws-port': '9944',
+        '--port': '30334',
+        '--validator-port': '30344',
+        '--public-validator-addresses': f'{addr}:30344',
+        '--execution': 'Native',
+        '--prometheus-port': '9615',
+        '--rpc-cors': 'all',
+        '--rpc-methods': 'Unsafe',
+        '--node-key-file': f'data/{auth}/p2p_secret',
+        '--bootnodes': bootnodes,
+    }
+
+    if custom_flags is None:
+        with open('node_flags.json', 'r') as f:
+            custom_flags = json.load(f)
+
+    val_flags.update(custom_flags)
+    val_flags = [f'{key} {val}' for (key, val) in val_flags.items()]
+
+    return " ".join(chain(no_val_flags, val_flags, debug_flags))
+
+
+def dev_bootnodes(addresses=None, keys=None):
+    ''' Bootnodes of a dev chain: the last two nodes of the fleet.'''
+
+    addresses = _lines('addresses') if addresses is None else addresses
+    keys = _lines('libp2p_public_keys') if keys is None else keys
+    libp2p_addresses = [f'/ip4/{address}/tcp/30334/p2p/{key}' for address, key in zip(addresses, keys)]
+
+    return " ".join(libp2p_addresses[-2:])
+
+
+def dispatch_cmd(pid, auth, addr, bootnodes, custom_flags=None):
+    ''' Command running the node of a given pid.'''
+
+    return f'/home/ubuntu/aleph-node {get_node_flags(auth, bootnodes, addr, custom_flags)} 2> {pid}.log'
+
+
+def db_snapshot_name():
+    ''' Name of the newest testnet db backup, the one of yesterday.'''
+
+    return f'db_backup_{date.today() - timedelta(days=1)}.tar.gz'
+
+
+def db_snapshot_url():
+    yesterday = date.today() - timedelta(days=1)
+    return f'{DB_SNAPSHOT_HOST}/{yesterday}/{db_snapshot_name()}'
+
+
+def db_relay_url(relay_ip):
+    ''' Url of the snapshot served by a relay host under a given (private) ip.'''
+
+    return f'http://{relay_ip}:{DB_RELAY_PORT}/{db_snapshot_name()}'
+
+
+def download_db_cmd(auth, url=None):
+    '''
+    Bash script streaming the testnet db backup into the base path of a given validator: the
+    download is piped straight into decompression and untar, so the archive never touches the
+    disk. Progress and throughput are appended to download_db.log every 10 seconds.
+    :param string url: where the backup is downloaded from, a relay or db_snapshot_url() by default
+    '''
+
+    url = url or db_snapshot_url()
+    target = f'data/{auth}/chains/testnet'
+
+    return '\n'.join([
+        'set -e -o pipefail',
+        'log() { echo "$(date +%T) $*" >> download_db.log; }',
+        f'url={url}',
+        'log started download from $url',
+        f'mkdir -p {target}',
+        'size=$(curl -sSIL "$url" | tr -d \'\\r\' | awk \'tolower($1) == "content-length:" {n = $2} END {print n + 0}\')',
+        'start=$(date +%s)',
+        'curl -sSL --fail --retry 5 "$url"'
+        ' | pv -f -i 10 -s "$size" -F \'progress %b %t rate %r avg %a %p\''
+        ' 2> >(tr \'\\r\' \'\\n\' | grep --line-buffered . >> download_db.log)'
+        f' | tar -xz -C {target}',
+        'took=$(( $(date +%s) - start + 1 ))',
+        'log "downloaded and unpacked $size bytes in ${took}s, $(( size / took / 1000000 )) MB/s"',
+    ]) + '\n'
+
+
+def build_bundle(pid, auth, scripts=None):
+    '''
+    Packs the bundle of a given pid.
+    :param dict scripts: name --> contents of dispatch scripts to include, none by default
+    '''
+
+    with tempfile.TemporaryDirectory(dir=BUNDLES_DIR) as tmp:
+        names = []
+        for name, contents in (scripts or {}).items():
+            with open(os.path.join(tmp, name), 'w') as f:
+                f.write(contents + '\n')
+            names.append(name)
+        scripts_part = f' -C {tmp} {" ".join(names)}' if names else ''
+        run(['bash', '-o', 'pipefail', '-c',
+             f'tar -cf - data/{auth}{scripts_part} | zstd -q -f -{TRANSFER_COMPRESSION} -o {bundle_path(pid)}.tmp'],
+            check=True)
+    os.replace(f'{bundle_path(pid)}.tmp', bundle_path(pid))
+
+    return bundle_path(pid)
+
+
+def build_bundles(pids, chain='dev', with_dispatch=True, db_urls=None, n_jobs=BUNDLE_JOBS):
+    '''
+    Builds bundles of all given pids in a pool of processes, dropping bundles built before.
+    Shared inputs (accounts, addresses, p2p keys, node flags) are read once here.
+    :param list pids: pids of nodes
+    :param bool with_dispatch: indicates whether dispatch scripts should be included, this needs
+        node_flags.json and, for testnet, the bootnodes file
+    :param dict db_urls: pid --> url the testnet node downloads the db backup from, db_snapshot_url() by default
+    :returns: dict pid --> path of the bundle
+    '''
+
+    from joblib import Parallel, delayed
+
+    shutil.rmtree(BUNDLES_DIR, ignore_errors=True)
+    os.makedirs(BUNDLES_DIR)
+
+    auths = _lines('validator_accounts')
+    scripts = {pid: None for pid in pids}
+    if with_dispatch:
+        addresses = _lines('addresses')
+        with open('node_flags.json', 'r') as f:
+            custom_flags = json.load(f)
+        if chain == 'testnet':
+            bootnodes = " ".join(_lines('bootnodes'))
+        else:
+            bootnodes = dev_bootnodes(addresses)
+        for pid in pids:
+            auth, addr = auths[int(pid)], addresses[int(pid)]
+            run_cmd = dispatch_cmd(pid, auth, addr, bootnodes, custom_flags)
+            scripts[pid] = {'cmd.sh': run_cmd}
+            if chain == 'testnet':
+                url = (db_urls or {}).get(pid)
+                scripts[pid]['download_run_cmd.sh'] = download_db_cmd(auth, url) + run_cmd
+
+    paths = Parallel(n_jobs=n_jobs)(
+        delayed(build_bundle)(pid, auths[int(pid)], scripts[pid]) for pid in pids)
+
+    return dict(zip(pids, paths))
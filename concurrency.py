@@ -0,0 +1,147 @@
+'''Adaptive limits on the number of concurrent operations of a given resource class.
+
+Every class (ec2 api calls, ssh handshakes, uploads) gets an AIMD limit: after every window of
+completions that stayed within LATENCY_TOLERANCE of the best latency seen for the operation against
+the same endpoint (region or host) the limit grows by one, on throttling, errors or inflated latency
+it is halved. Latencies of different endpoints are never compared, so regions or hosts that are
+simply farther away do not count as congestion. Every change of
+a limit is recorded in the trace log as a counter, so it shows up next to spans of the run.
+'''
+
+from contextlib import contextmanager
+from threading import Condition, Lock
+from time import time
+
+from tracing import counter, mark
+
+# set to False to keep every limit fixed at its initial value
+ADAPTIVE_CONCURRENCY = True
+# initial, minimal and maximal number of concurrent operations of every resource class
+CONCURRENCY = {
+    'ec2': {'initial': 8, 'minimum': 1, 'maximum': 48},
+    'ssh': {'initial': 16, 'minimum': 2, 'maximum': 128},
+    'upload': {'initial': 8, 'minimum': 1, 'maximum': 64},
+}
+# completions slower than this many times the best latency of the operation count as congestion
+LATENCY_TOLERANCE = 2.
+# latencies within this many seconds of the best one never count as congestion
+LATENCY_SLACK = .1
+DECREASE_FACTOR = .5
+
+THROTTLING_CODES = {'RequestLimitExceeded', 'Throttling', 'ThrottlingException', 'TooManyRequestsException',
+                    'SlowDown', 'RequestThrottled'}
+
+_limiters = {}
+_limiters_lock = Lock()
+
+
+def is_throttling(exc):
+    '''
+    Checks if an exception means the other side is overloaded: an aws throttling error or an ssh
+    handshake dropped by the server (which is how sshd enforces MaxStartups).
+    '''
+
+    response = getattr(exc, 'response', None)
+    if isinstance(response, dict) and response.get('Error', {}).get('Code') in THROTTLING_CODES:
+        return True
+
+    return isinstance(exc, (ConnectionResetError, EOFError)) or 'protocol banner' in str(exc)
+
+
+class AdaptiveLimit:
+    '''
+    A semaphore whose size follows the AIMD rule. Operations started before the last decrease do
+    not trigger another one, so a single congestion event halves the limit only once.
+    '''
+
+    def __init__(self, name, initial, minimum=1, maximum=64):
+        self.name = name
+        self.limit, self.minimum, self.maximum = min(max(initial, minimum), maximum), minimum, maximum
+        self.in_flight = 0
+        self.successes = 0
+        self.best = {}
+        self.last_decrease = 0.
+        self.cond = Condition()
+
+    def acquire(self):
+        ''' Blocks until the number of running operations is below the limit, returns the start time.'''
+
+        with self.cond:
+            while self.in_flight >= self.limit:
+                self.cond.wait()
+            self.in_flight += 1
+
+        return time()
+
+    def release(self, op, start, ok=True, throttled=False, endpoint=None):
+        '''
+        Marks an operation started at start as finished and adjusts the limit.
+        :param string op: name of the operation, latencies are compared only among the same operations
+        :param bool ok: indicates whether the operation succeeded
+        :param bool throttled: indicates whether the operation was rejected or slowed down by the other side
+        :param string endpoint: region or host the operation went to, latencies are compared only within it
+        '''
+
+        latency = time() - start
+        with self.cond:
+            self.in_flight -= 1
+            if ADAPTIVE_CONCURRENCY:
+                if throttled or not ok:
+                    self._decrease(start, 'throttled' if throttled else 'error', op)
+                else:
+                    key = (op, endpoint)
+                    best = self.best[key] = min(self.best.get(key, latency), latency)
+                    if latency > best * LATENCY_TOLERANCE + LATENCY_SLACK:
+                        self._decrease(start, f'latency {round(latency, 2)}s > {round(best, 2)}s', op)
+                    else:
+                        self.successes += 1
+                        if self.successes >= self.limit and self.limit < self.maximum:
+                            self._set(self.limit + 1, 'latency flat', op)
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, op, endpoint=None):
+        ''' Runs the body as one operation, an exception counts as a failure.'''
+
+        start = self.acquire()
+        try:
+            yield
+        except Exception as e:
+            self.release(op, start, ok=False, throttled=is_throttling(e), endpoint=endpoint)
+            raise
+        self.release(op, start, endpoint=endpoint)
+
+    def _decrease(self, start, reason, op):
+        if start < self.last_decrease or self.limit <= self.minimum:
+            return
+        self.last_decrease = time()
+        self._set(max(self.minimum, int(self.limit * DECREASE_FACTOR)), reason, op)
+        print(f'{self.name} concurrency lowered to {self.limit}: {reason} ({op})')
+
+    def _set(self, limit, reason, op):
+        self.limit = limit
+        self.successes = 0
+        counter(f'{self.name} concurrency', limit, 'concurrency')
+        mark(f'{self.name} concurrency {limit}', 'concurrency', track=f'{self.name} concurrency',
+             reason=reason, op=op)
+
+
+def limiter(resource):
+    ''' Returns the limit shared by all operations of a given resource class in this process.'''
+
+    with _limiters_lock:
+        if resource not in _limiters:
+            _limiters[resource] = AdaptiveLimit(resource, **CONCURRENCY[resource])
+            counter(f'{resource} concurrency', _limiters[resource].limit, 'concurrency')
+        return _limiters[resource]
+
+
+def configure_concurrency(resource, **params):
+    '''
+    Changes initial, minimum or maximum concurrency of a given resource class. The limit starts
+    over from the initial value, e.g. configure_concurrency('upload', initial=4, maximum=4) fixes it at 4.
+    '''
+
+    with _limiters_lock:
+        CONCURRENCY[resource] = dict(CONCURRENCY[resource], **params)
+        _limiters.pop(resource, None)
@@ -0,0 +1,438 @@
+'''Dispatch of fabfile tasks to hosts, either in-process over persistent, pooled ssh connections
+or with GNU parallel spawning a fab process per host.'''
+
+import atexit
+import importlib.util
+import inspect
+import os
+import sys
+import tempfile
+from collections import defaultdict, deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from subprocess import run
+from threading import Lock, Semaphore
+from time import time
+
+from concurrency import is_throttling, limiter
+from tracing import record
+from utils import fab_cmd
+
+DISPATCH_WORKERS = 32
+KEY_PATH = 'key_pairs/aleph.pem'
+KEEPALIVE_INTERVAL = 30
+CONNECT_TIMEOUT = 10
+# time in seconds after which a command run with run_cmd_on_hosts is killed, None for no limit
+CMD_TIMEOUT = None
+TAIL_LINES = 20
+PIPELINE_WORKERS = 256
+# bounds on the number of hosts running a given phase at once in pipelined mode,
+# phases not listed here are bounded by DISPATCH_WORKERS
+PHASE_LIMITS = {}
+# tasks sending large files, their concurrency follows the adaptive 'upload' limit
+UPLOAD_TASKS = {'send-data', 'send-binary', 'send-new-binary', 'send-cli-binary', 'send-flooder-binary',
+                'setup-contract-repo'}
+
+TaskResult = namedtuple('TaskResult', ['host', 'region', 'pid', 'task', 'exit_status',
+                                       'start', 'end', 'stdout', 'stderr'])
+CmdResult = namedtuple('CmdResult', ['host', 'region', 'cmd', 'exit_status', 'start', 'end', 'stdout', 'stderr'])
+
+_connections = {}
+_connections_lock = Lock()
+# host --> lock held while the connection to the host is being opened
+_open_locks = {}
+_fabfile = None
+_print_lock = Lock()
+
+
+def fabfile():
+    ''' Returns the fabfile module, the one pointed to by FABFILE_PATH if it is set.'''
+
+    global _fabfile
+
+    if _fabfile is None:
+        path = os.environ.get('FABFILE_PATH')
+        if path:
+            if os.path.isdir(path):
+                path = os.path.join(path, 'fabfile.py')
+            spec = importlib.util.spec_from_file_location('fabfile', path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+            _fabfile = module
+        else:
+            import fabfile as module
+            _fabfile = module
+
+    return _fabfile
+
+
+def connection(host, user='ubuntu'):
+    '''
+    Returns the connection to a given host, opening it on first use. The connection stays open
+    for the rest of the session, every command runs in a new channel of the same ssh transport.
+    '''
+
+    from fabric import Connection
+
+    with _connections_lock:
+        conn = _connections.get(host)
+        if conn is None:
+            conn = Connection(host, user=user, connect_timeout=CONNECT_TIMEOUT,
+                              connect_kwargs={'key_filename': KEY_PATH})
+            # commands run from many threads at once, none of them may read local stdin
+            conn.config.run.in_stream = False
+            _connections[host] = conn
+        open_lock = _open_locks.setdefault(host, Lock())
+
+    # threads reaching the same host at once must not handshake twice
+    with open_lock:
+        if not conn.is_connected:
+            with limiter('ssh').slot('handshake', host):
+                conn.open()
+            conn.transport.set_keepalive(KEEPALIVE_INTERVAL)
+
+    return conn
+
+
+def close_connections():
+    with _connections_lock:
+        for conn in _connections.values():
+            conn.close()
+        _connections.clear()
+
+
+atexit.register(close_connections)
+
+
+def task_connection(host, out_stream, err_stream):
+    '''
+    Returns a connection to a given host sharing the transport of the pooled one, with its
+    own config writing the output of remote commands to given streams. Tasks running
+    concurrently on the same host thus never capture each other's output. The returned
+    connection must not be closed, as that would close the pooled transport.
+    :param string host: address of the host
+    :param out_stream: file-like object receiving stdout of remote commands
+    :param err_stream: file-like object receiving stderr of remote commands
+    '''
+
+    shared = connection(host)
+    config = shared.config.clone()
+    config.run.out_stream, config.run.err_stream = out_stream, err_stream
+    conn = Connection(host, user=shared.user, port=shared.port, config=config)
+    conn.client, conn.transport = shared.client, shared.transport
+
+    return conn
+
+
+class _TailStream:
+    ''' File-like sink keeping only the last TAIL_LINES lines written to it.'''
+
+    def __init__(self):
+        self.lines = deque(maxlen=TAIL_LINES)
+        self.partial = ''
+
+    def write(self, data):
+        lines = (self.partial + data).split('\n')
+        self.partial = lines.pop()
+        self.lines.extend(lines)
+
+    def flush(self):
+        pass
+
+    def tail(self):
+        return '\n'.join(list(self.lines) + ([self.partial] if self.partial else []))
+
+
+def run_task_on_host(task, host, pid=None, region=None):
+    '''
+    Runs a task defined in fabfile.py (e.g. 'send-data') on a given host. Output of remote
+    commands is captured instead of printed.
+    :returns: TaskResult
+    '''
+
+    func = getattr(fabfile(), task.replace('-', '_'))
+    out, err = _TailStream(), _TailStream()
+    exit_status, throttled = 0, False
+    upload = limiter('upload') if task in UPLOAD_TASKS else None
+    start = time() if upload is None else upload.acquire()
+    try:
+        conn = task_connection(host, out, err)
+        if pid is None:
+            func(conn)
+        else:
+            func(conn, pid=pid)
+    except Exception as e:
+        # UnexpectedExit carries the exit code of the failed remote command
+        result = getattr(e, 'result', None)
+        exit_status = getattr(result, 'exited', None) or -1
+        throttled = is_throttling(e)
+        err.write(f'\n{type(e).__name__}: {e}')
+    if upload is not None:
+        upload.release(task, start, exit_status == 0, throttled, host)
+
+    res = TaskResult(host, region, pid, task, exit_status, start, time(), out.tail(), err.tail())
+    _record(res)
+
+    return res
+
+
+def _record(res):
+    record(res.task, res.start, res.end, 'task', track=res.host,
+           region=res.region, pid=res.pid, exit_status=res.exit_status)
+
+
+class _HostStream:
+    ''' File-like sink capturing everything written to it, optionally echoing lines tagged with the host.'''
+
+    def __init__(self, host, echo, sink):
+        self.host, self.echo, self.sink = host, echo, sink
+        self.chunks = []
+        self.partial = ''
+
+    def write(self, data):
+        self.chunks.append(data)
+        if self.echo:
+            lines = (self.partial + data).split('\n')
+            self.partial = lines.pop()
+            self._print(lines)
+
+    def flush(self):
+        if self.echo and self.partial:
+            self._print([self.partial])
+            self.partial = ''
+
+    def _print(self, lines):
+        with _print_lock:
+            for line in lines:
+                print(f'[{self.host}] {line}', file=self.sink)
+
+    def value(self):
+        return ''.join(self.chunks)
+
+
+def run_cmd_on_host(cmd, host, region=None, timeout=CMD_TIMEOUT, stream=False):
+    '''
+    Runs a shell command on a given host over its pooled connection.
+    :param bool stream: indicates whether output should be printed live, each line tagged with the host
+    :returns: CmdResult, exit status is -1 if the command could not be run or timed out
+    '''
+
+    out, err = _HostStream(host, stream, sys.stdout), _HostStream(host, stream, sys.stderr)
+    start = time()
+    try:
+        res = connection(host).run(cmd, warn=True, timeout=timeout, out_stream=out, err_stream=err)
+        exit_status = res.exited
+    except Exception as e:
+        exit_status = -1
+        err.write(f'{type(e).__name__}: {e}\n')
+    out.flush()
+    err.flush()
+
+    record('cmd', start, time(), 'cmd', track=host, cmd=cmd, exit_status=exit_status)
+
+    return CmdResult(host, region, cmd, exit_status, start, time(), out.value(), err.value())
+
+
+def run_cmd_on_hosts(cmd, hosts, regions=None, timeout=CMD_TIMEOUT, stream=False, max_workers=DISPATCH_WORKERS):
+    '''
+    Runs a shell command on all given hosts concurrently.
+    :param list regions: regions of hosts, only used to label results
+    :param int timeout: time in seconds after which the command is killed on a host
+    :param bool stream: indicates whether output should be printed live, each line tagged with the host
+    :returns: list of CmdResult in the order of hosts
+    '''
+
+    regions = [None] * len(hosts) if regions is None else regions
+    if not hosts:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        return list(pool.map(lambda args: run_cmd_on_host(cmd, *args, timeout, stream), zip(hosts, regions)))
+
+
+def _normalize(hosts, pids, regions):
+    pids = [None] * len(hosts) if pids is None else [None if pid is None else str(pid) for pid in pids]
+    regions = [None] * len(hosts) if regions is None else regions
+
+    return pids, regions
+
+
+def run_task_on_hosts(task, hosts, pids=None, max_workers=DISPATCH_WORKERS, regions=None):
+    '''
+    Runs a task defined in fabfile.py on all given hosts over pooled connections.
+    :param list hosts: ips of hosts
+    :param list pids: pids passed to the task, one per host, or None if the task takes no pid
+    :param int max_workers: number of hosts served concurrently
+    :param list regions: regions of hosts, only used to label results
+    :returns: list of TaskResult in the order of hosts
+    '''
+
+    pids, regions = _normalize(hosts, pids, regions)
+    if not hosts:
+        return []
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        results = list(pool.map(lambda args: run_task_on_host(task, *args), zip(hosts, pids, regions)))
+
+    _report_failures(results)
+
+    return results
+
+
+def run_task_with_parallel(task, hosts, pids=None, parallel=True, regions=None):
+    '''
+    Runs a task defined in fabfile.py on all given hosts with GNU parallel, one fab process per
+    host. Timings and exit codes are read from the job log, output lines are told apart by tags.
+    :returns: list of TaskResult in the order of hosts
+    '''
+
+    pids, regions = _normalize(hosts, pids, regions)
+    if not hosts:
+        return []
+
+    with tempfile.NamedTemporaryFile('r', suffix='.joblog') as joblog:
+        # every job opens its own ssh connection, so the number of jobs follows the 'ssh' limit
+        cmd = ['parallel', '--joblog', joblog.name, '--tagstring', '{#}',
+               '-j', str(limiter('ssh').limit if parallel else 1)]
+        cmd += fab_cmd().split() + ['-H', '{1}', task]
+        if pids[0] is not None:
+            cmd += ['--pid={2}']
+        cmd += [':::'] + ['ubuntu@' + host for host in hosts]
+        if pids[0] is not None:
+            cmd += [':::+'] + pids
+        proc = run(cmd, capture_output=True, text=True)
+
+        # Seq Host Starttime JobRuntime Send Receive Exitval Signal Command
+        jobs = {}
+        for line in joblog.read().splitlines()[1:]:
+            fields = line.split('\t')
+            jobs[int(fields[0])] = (float(fields[2]), float(fields[3]), int(fields[6]))
+
+    outs, errs = defaultdict(_TailStream), defaultdict(_TailStream)
+    for streams, output in [(outs, proc.stdout), (errs, proc.stderr)]:
+        for line in output.splitlines():
+            seq, _, text = line.partition('\t')
+            if seq.isdigit():
+                streams[int(seq)].write(text + '\n')
+
+    results = []
+    for seq, (host, pid, region) in enumerate(zip(hosts, pids, regions), 1):
+        start, runtime, exit_status = jobs.get(seq, (None, 0., -1))
+        end = None if start is None else start + runtime
+        results.append(TaskResult(host, region, pid, task, exit_status, start, end,
+                                  outs[seq].tail(), errs[seq].tail()))
+        _record(results[-1])
+
+    _report_failures(results)
+
+    return results
+
+
+def task_takes_pid(task):
+    ''' Checks if a task defined in fabfile.py has a pid parameter.'''
+
+    func = getattr(fabfile(), task.replace('-', '_'))
+    return 'pid' in inspect.signature(getattr(func, 'body', func)).parameters
+
+
+def run_pipeline_on_hosts(phases, hosts, pids=None, regions=None, limits=None, done=None, on_result=None):
+    '''
+    Runs a sequence of tasks defined in fabfile.py on all given hosts, every host moving to its next
+    phase as soon as it finishes the previous one, without waiting for other hosts. A host stops at
+    its first failed phase. Pids are passed only to tasks that take them.
+    :param list phases: names of tasks in the order they should run on every host
+    :param dict limits: phase --> max number of hosts running it at once, defaults to PHASE_LIMITS
+    :param dict done: host --> collection of phases the host completed before, they are skipped
+    :param on_result: function called with every TaskResult as soon as the phase finishes
+    :returns: list of TaskResult, grouped by host in the order of hosts
+    '''
+
+    pids, regions = _normalize(hosts, pids, regions)
+    if not hosts:
+        return []
+
+    limits = dict(PHASE_LIMITS, **(limits or {}))
+    semaphores = {phase: Semaphore(limits.get(phase, DISPATCH_WORKERS)) for phase in phases}
+    takes_pid = {phase: task_takes_pid(phase) for phase in phases}
+
+    done = done or {}
+
+    def chain(host, pid, region):
+        results = []
+        for phase in phases:
+            if phase in done.get(host, ()):
+                continue
+            with semaphores[phase]:
+                res = run_task_on_host(phase, host, pid if takes_pid[phase] else None, region)
+            if on_result is not None:
+                on_result(res)
+            results.append(res)
+            if res.exit_status != 0:
+                break
+        return results
+
+    with ThreadPoolExecutor(max_workers=min(len(hosts), PIPELINE_WORKERS)) as pool:
+        chains = list(pool.map(lambda args: chain(*args), zip(hosts, pids, regions)))
+
+    results = [res for results in chains for res in results]
+    for phase in phases:
+        _report_failures([res for res in results if res.task == phase])
+
+    return results
+
+
+def _report_failures(results):
+    failed = [res.host for res in results if res.exit_status != 0]
+    if failed:
+        print(f'task {results[0].task} failed on', *failed)
+
+
+def _percentile(values, q):
+    ''' Nearest-rank percentile of a sorted list.'''
+
+    return values[max(0, -(-len(values) * q // 100) - 1)]
+
+
+def task_summary(results):
+    '''
+    Computes duration statistics of task results per task and per (task, region).
+    :returns: dict key --> dict with number of hosts and failures, p50/p95/max duration in
+        seconds and the slowest host; key is a task name or a pair (task, region)
+    '''
+
+    groups = defaultdict(list)
+    for res in results:
+        groups[res.task].append(res)
+        if res.region is not None:
+            groups[(res.task, res.region)].append(res)
+
+    summary = {}
+    for key, group in groups.items():
+        timed = sorted((res for res in group if res.start is not None), key=lambda r: r.end - r.start)
+        durations = [res.end - res.start for res in timed]
+        summary[key] = {
+            'hosts': len(group),
+            'failures': sum(res.exit_status != 0 for res in group),
+            'p50': _percentile(durations, 50) if durations else None,
+            'p95': _percentile(durations, 95) if durations else None,
+            'max': durations[-1] if durations else None,
+            'slowest': timed[-1].host if timed else None,
+        }
+
+    return summary
+
+
+def print_task_summary(results):
+    ''' Prints duration statistics per task and region, and the output of failed hosts.'''
+
+    def fmt(t):
+        return '-' if t is None else f'{t:.2f}s'
+
+    for key, stats in task_summary(results).items():
+        name = key if isinstance(key, str) else f'  {key[1]}'
+        print(f'{name:28} hosts {stats["hosts"]:4}  failed {stats["failures"]:4}  p50 {fmt(stats["p50"]):>9}'
+              f'  p95 {fmt(stats["p95"]):>9}  max {fmt(stats["max"]):>9}  slowest {stats["slowest"]}')
+
+    for res in results:
+        if res.exit_status != 0:
+            print(f'--- {res.task} on {res.host} (pid {res.pid}) exited with {res.exit_status}:')
+            print(res.stderr or res.stdout)
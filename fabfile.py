@@ -1,12 +1,15 @@
 '''Routines called by fab. Assumes that all are called from */experiments/aws.'''
-import json
-from itertools import chain
+from io import BytesIO
 from os import remove
-from subprocess import Popen, call, PIPE
-from datetime import date, timedelta
+from subprocess import Popen, PIPE
 
 from fabric import task
 
+from artifacts import send_artifact
+from bundles import (DB_RELAY_DIR, DB_RELAY_PORT, bundle_path, db_snapshot_name, db_snapshot_url, dev_bootnodes,
+                     dispatch_cmd, download_db_cmd)
+from transfer import get_tree, send_stream, send_tree
+
 
 # ======================================================================================
 #                                   setup
@@ -15,8 +18,10 @@ from fabric import task
 
 @task
 def setup(conn):
-    conn.run('sudo apt update', hide='both')
-    conn.run('sudo apt install -y zip unzip dtach', hide='both')
+    # apt is slow even when there is nothing to do, so rerunning setup skips it
+    if conn.run('dpkg -s zip unzip dtach zstd pv', hide='both', warn=True).failed:
+        conn.run('sudo apt update', hide='both')
+        conn.run('sudo apt install -y zip unzip dtach zstd pv', hide='both')
     conn.run('sudo sh -c "echo core >/proc/sys/kernel/core_pattern"', hide='both')
 
 
@@ -29,18 +34,14 @@ def docker_setup(conn):
 
 @task
 def send_data(conn, pid):
-    ''' Sends keys and addresses. '''
-    # sends all the keys, refactor to send only the needed one
+    ''' Sends keys (and dispatch scripts if bundled, see bundles.py) and the chainspec. '''
 
-    auth = pid_to_auth(pid)
-    zip_file = f'data{pid}.zip'
-    cmd = f'zip -r {zip_file} data/{auth}'
-    with open('x', 'w') as f:
-        f.write(cmd)
-    call(cmd.split())
-    conn.put(f'{zip_file}', '.')
-    conn.run(f'unzip /home/ubuntu/{zip_file}')
-    conn.put('chainspec.json', '.')
+    try:
+        with open(bundle_path(pid), 'rb') as f:
+            send_stream(conn, f, 'zstd -q -dc | tar -xf -')
+    except FileNotFoundError:
+        send_tree(conn, [f'data/{pid_to_auth(pid)}'])
+    send_artifact(conn, 'chainspec.json')
 
 
 @task
@@ -69,10 +70,10 @@ def update_node_image(conn):
 
 @task
 def get_logs(conn, pid):
+    # the log keeps growing, so a snapshot of it is sent
     conn.run(f'cp /home/ubuntu/{pid}.log node{pid}.log')
-    conn.run(f'zip {pid}.log.zip node{pid}.log')
+    get_tree(conn, [f'node{pid}.log'], 'logs')
     conn.run(f'rm node{pid}.log')
-    conn.get(f'/home/ubuntu/{pid}.log.zip', 'logs/')
 
 
 @task
@@ -114,8 +115,8 @@ def run_docker_compose(conn, pid):
 
 @task
 def send_binary(conn):
-    ''' Zips, sends and unzips the binary. '''
-    send_zip(conn, 'aleph-node.zip', 'bin/aleph-node')
+    ''' Sends the binary unless the host already has the same version. '''
+    send_artifact(conn, 'bin/aleph-node')
 
 # ======================================================================================
 #                                       nginx
@@ -124,7 +125,8 @@ def send_binary(conn):
 
 @task
 def run_nginx(conn):
-    conn.run('sudo apt install -y nginx', hide='both')
+    if conn.run('dpkg -s nginx', hide='both', warn=True).failed:
+        conn.run('sudo apt install -y nginx', hide='both')
     conn.put('nginx/default', '.')
     conn.run('sudo mv /home/ubuntu/default /etc/nginx/sites-available/')
     conn.put('nginx/cert/self-signed.crt', '.')
@@ -150,63 +152,11 @@ def pid_to_addr(pid):
         return f.readlines()[int(pid)].strip()
 
 
-def get_node_flags(auth, bootnodes, addr):
-    no_val_flags = [
-        '--validator',
-        '--prometheus-external',
-        '--no-telemetry',
-        '--unsafe-ws-external',
-        '--unsafe-rpc-external',
-    ]
-    debug_flags = [
-        '-laleph-network=debug',
-        '-laleph-party=debug',
-        '-lAlephBFT-creator=debug',
-    ]
-    val_flags = {
-        '--chain': 'chainspec.json',
-        '--base-path': f'data/{auth}',
-        '--rpc-port': '9933',
-        '--ws-port': '9944',
-        '--port': '30334',
-        '--validator-port': '30344',
-        '--public-validator-addresses': f'{addr}:30344',
-        '--execution': 'Native',
-        '--prometheus-port': '9615',
-        '--rpc-cors': 'all',
-        '--rpc-methods': 'Unsafe',
-        '--node-key-file': f'data/{auth}/p2p_secret',
-        '--bootnodes': bootnodes,
-    }
-
-    with open('node_flags.json', 'r') as f:
-        custom_val_flags = json.load(f)
-
-    val_flags.update(custom_val_flags)
-    val_flags = [f'{key} {val}' for (key, val) in val_flags.items()]
-
-    return " ".join(chain(no_val_flags, val_flags, debug_flags))
-
-
 @task
 def create_dispatch_cmd(conn, pid):
     ''' Runs the protocol.'''
 
-    libp2p_addresses = []
-    with open("addresses", "r") as f:
-        addresses = [addr.strip() for addr in f.readlines()]
-    with open("libp2p_public_keys", "r") as f:
-        keys = [key.strip() for key in f.readlines()]
-    for address, key in zip(addresses, keys):
-        libp2p_addresses.append(
-            f'/ip4/{address}/tcp/30334/p2p/{key}')
-    bootnodes = " ".join(libp2p_addresses[-2:])
-
-    auth = pid_to_auth(pid)
-    addr = pid_to_addr(pid)
-    flags = get_node_flags(auth, bootnodes, addr)
-
-    cmd = f'/home/ubuntu/aleph-node {flags} 2> {pid}.log'
+    cmd = dispatch_cmd(pid, pid_to_auth(pid), pid_to_addr(pid), dev_bootnodes())
     conn.run("echo > /home/ubuntu/cmd.sh")
     conn.run(f"sed -i '$a{cmd}' /home/ubuntu/cmd.sh")
 
@@ -221,23 +171,32 @@ def create_testnet_dispatch_cmd(conn, pid):
     bootnodes = " ".join(bootnodes)
 
     auth = pid_to_auth(pid)
-    addr = pid_to_addr(pid)
-    flags = get_node_flags(auth, bootnodes, addr)
-    run_cmd = f'/home/ubuntu/aleph-node {flags} 2> {pid}.log'
+    run_cmd = dispatch_cmd(pid, auth, pid_to_addr(pid), bootnodes)
     conn.run("echo > /home/ubuntu/cmd.sh")
     conn.run(f"sed -i '$a{run_cmd}' /home/ubuntu/cmd.sh")
 
-    today = date.today()
-    yesterday = today - timedelta(days=1)
-    download_cmd = f'set -e; echo Started download >> download_db.log; '\
-        f'wget -c -O db.tar.gz https://db.test.azero.dev/{yesterday}/db_backup_{yesterday}.tar.gz -nv -a download_db.log; '\
-        f'echo Started unpacking db >> download_db.log; '\
-        f'tar xvzf db.tar.gz -C data/{auth}/chains/testnet; '\
-        f'echo Unpacking done, removing tar.gz >> download_db.log; '\
-        'rm db.tar.gz; '
-    conn.run("echo > /home/ubuntu/download_run_cmd.sh")
-    conn.run(
-        f"sed -i '$a{download_cmd}{run_cmd}' /home/ubuntu/download_run_cmd.sh")
+    script = download_db_cmd(auth) + run_cmd + '\n'
+    send_stream(conn, BytesIO(script.encode()), 'cat > /home/ubuntu/download_run_cmd.sh')
+
+
+@task
+def fetch_db_snapshot(conn):
+    ''' Makes the host a relay of the testnet db backup: downloads it once with parallel, resumable
+    range requests and serves it over http to nodes of its region. '''
+
+    if conn.run('dpkg -s aria2', hide='both', warn=True).failed:
+        conn.run('sudo apt update', hide='both')
+        conn.run('sudo apt install -y aria2', hide='both')
+
+    name = db_snapshot_name()
+    conn.run(f'mkdir -p {DB_RELAY_DIR} && find {DB_RELAY_DIR} -type f ! -name "{name}*" -delete')
+    # an .aria2 control file means the download was interrupted, aria2c -c resumes it
+    if conn.run(f'test -f {DB_RELAY_DIR}/{name} -a ! -f {DB_RELAY_DIR}/{name}.aria2', hide='both', warn=True).failed:
+        conn.run(f'aria2c -c -x 16 -s 16 -k 16M --file-allocation=none --summary-interval=30 '
+                 f'-d {DB_RELAY_DIR} -o {name} {db_snapshot_url()} >> db_relay.log 2>&1')
+
+    conn.run(f'pgrep -f "http[.]server {DB_RELAY_PORT}" || dtach -n `mktemp -u /tmp/dtach.XXXX` '
+             f'python3 -m http.server {DB_RELAY_PORT} --bind `hostname -I | cut -d" " -f1` --directory {DB_RELAY_DIR}')
 
 
 @task
@@ -251,7 +210,7 @@ def purge(conn, pid):
 def download_db_dispatch(conn):
     run_node_exporter(conn)
     conn.run(
-        f'dtach -n `mktemp -u /tmp/dtach.XXXX` sh /home/ubuntu/download_run_cmd.sh')
+        f'dtach -n `mktemp -u /tmp/dtach.XXXX` bash /home/ubuntu/download_run_cmd.sh')
 
 
 @task
@@ -304,7 +263,7 @@ def stop_world(conn):
 @task
 def send_new_binary(conn):
     # 1. send new binary
-    send_zip(conn, 'aleph-node-new.zip', 'bin/aleph-node-new')
+    send_artifact(conn, 'bin/aleph-node-new')
 
     # 2. make backups
     conn.run(
@@ -329,8 +288,8 @@ def upgrade_binary(conn):
 
 @task
 def send_cli_binary(conn):
-    ''' Zips, sends and unzips the rotation binary. '''
-    send_zip(conn, 'cliain.zip', 'bin/cliain')
+    ''' Sends the rotation binary unless the host already has the same version. '''
+    send_artifact(conn, 'bin/cliain')
 
 
 @task
@@ -460,7 +419,7 @@ def monitor_flood(conn):
 @task
 def send_flooder_binary(conn):
     # 1. send new binary
-    send_zip(conn, 'flooder.zip', 'bin/flooder')
+    send_artifact(conn, 'bin/flooder')
 
 
 @task
@@ -491,8 +450,7 @@ def _start_flooding(conn):
 
 @task
 def setup_contract_repo(conn):
-    conn.put('./bin/repo.zip', '.')
-    conn.run(f'unzip -o /home/ubuntu/repo.zip && rm repo.zip')
+    send_tree(conn, ['contracts-cli'], local_dir='bin')
     conn.put('smart_flooder_setup.sh', '.')
     conn.run('./smart_flooder_setup.sh contracts-cli')
 
@@ -511,7 +469,7 @@ def start_smart_flooder(conn):
 
 @task
 def send_chainspec(conn):
-    conn.put('chainspec.json', '.')
+    send_artifact(conn, 'chainspec.json')
 
 
 @task
@@ -535,13 +493,6 @@ def schedule_termination(conn):
 # ======================================================================================
 
 
-def send_zip(conn, zip_file, file):
-    cmd = f'zip -j {zip_file} {file}'
-    call(cmd.split())
-    conn.put(f'{zip_file}', '.')
-    conn.run(f'unzip -o /home/ubuntu/{zip_file} && rm {zip_file}')
-
-
 def run_node_exporter(conn):
     run_node_exporter_cmd = f'./node_exporter-*.*-amd64/node_exporter'
     conn.run(f'dtach -n `mktemp -u /tmp/dtach.XXXX` {run_node_exporter_cmd}')
@@ -0,0 +1,79 @@
+'''Local fleet inventory: tag --> region --> instance records, cached with ttl and persisted on disk.'''
+
+import os
+from time import time
+
+from utils import InstanceRecord, describe_tagged_instances, file_lock, read_json, write_json_atomic
+
+INVENTORY_PATH = '.inventory.json'
+INVENTORY_TTL = 600
+INVENTORY_STATES = ('running', 'pending')
+
+# in-memory copy of the file together with the mtime it was read at
+_inventory = {}
+_inventory_mtime = None
+
+
+def _load():
+    ''' Rereads the inventory file if it changed since the last read.'''
+
+    global _inventory, _inventory_mtime
+
+    try:
+        mtime = os.stat(INVENTORY_PATH).st_mtime_ns
+    except FileNotFoundError:
+        _inventory, _inventory_mtime = {}, None
+        return _inventory
+
+    if mtime != _inventory_mtime:
+        _inventory, _inventory_mtime = read_json(INVENTORY_PATH, {}), mtime
+
+    return _inventory
+
+
+def _store(inventory):
+    global _inventory, _inventory_mtime
+
+    write_json_atomic(INVENTORY_PATH, inventory)
+    _inventory, _inventory_mtime = inventory, os.stat(INVENTORY_PATH).st_mtime_ns
+
+
+def inventory_instances_in_region(region_name, tag='dev', ttl=INVENTORY_TTL):
+    '''
+    Returns records of running or pending instances in a given region, served from the inventory
+    if the entry is younger than ttl seconds. Otherwise aws is asked and the inventory is updated.
+    Regions with instances that have no public ip yet are never cached.
+    '''
+
+    entry = _load().get(tag, {}).get(region_name)
+    if entry is not None and time() - entry['time'] < ttl:
+        return [InstanceRecord(*record) for record in entry['instances']]
+
+    records = describe_tagged_instances(region_name, tag, INVENTORY_STATES)
+    if all(record.public_ip for record in records):
+        with file_lock(INVENTORY_PATH):
+            inventory = dict(_load())
+            inventory.setdefault(tag, {})[region_name] = {
+                'time': time(), 'instances': [list(record) for record in records]}
+            _store(inventory)
+
+    return records
+
+
+def invalidate_inventory(tag=None, regions=None):
+    '''
+    Drops cached entries. With no arguments the whole inventory is dropped, otherwise only
+    entries for a given tag and/or given regions.
+    '''
+
+    with file_lock(INVENTORY_PATH):
+        inventory = dict(_load())
+        for t in list(inventory):
+            if tag is not None and t != tag:
+                continue
+            if regions is None:
+                inventory.pop(t)
+            else:
+                for region_name in regions:
+                    inventory[t].pop(region_name, None)
+        _store(inventory)
@@ -0,0 +1,104 @@
+'''Run journal: stages and per-host tasks completed by setup runs of a given tag, persisted on disk.
+
+A setup run that fails partway can be resumed with the same parameters; completed stages return
+their journaled results and tasks are dispatched only to hosts that did not complete them yet.
+Pids assigned to hosts are journaled too, so a resumed run sends every host the data of the same pid.
+'''
+
+from time import time
+
+from utils import file_lock, read_json, write_json_atomic
+
+JOURNAL_PATH = '.journal.json'
+
+
+def _update(tag, update):
+    with file_lock(JOURNAL_PATH):
+        journal = read_json(JOURNAL_PATH, {})
+        update(journal.setdefault(tag, {'run': None, 'stages': {}, 'hosts': {}}))
+        write_json_atomic(JOURNAL_PATH, journal)
+
+
+def journal_of(tag):
+    ''' Returns the journal of a given tag: dict with the run, completed stages and completed tasks per host.'''
+
+    return read_json(JOURNAL_PATH, {}).get(tag, {'run': None, 'stages': {}, 'hosts': {}})
+
+
+def start_run(tag, routine, params):
+    '''
+    Starts a new journal for a given tag, dropping the previous one.
+    :param string routine: name of the routine in shell.py that is run, e.g. 'setup_nodes'
+    :param dict params: keyword arguments of the routine, they have to be json serializable
+    '''
+
+    def update(entry):
+        entry.update(run={'routine': routine, 'params': params, 'time': time()}, stages={}, hosts={}, pids={})
+
+    _update(tag, update)
+
+
+def stage_done(tag, stage, result=None):
+    ''' Records that a stage of the run of a given tag completed with a given (json serializable) result.'''
+
+    _update(tag, lambda entry: entry['stages'].__setitem__(stage, {'result': result, 'time': time()}))
+
+
+def completed_stages(tag):
+    ''' Returns dict stage --> result of stages completed by the run of a given tag.'''
+
+    return {stage: done['result'] for stage, done in journal_of(tag)['stages'].items()}
+
+
+def tasks_done(tag, results):
+    ''' Records tasks that completed successfully, given a list of TaskResult.'''
+
+    results = [res for res in results if res.exit_status == 0]
+    if not results:
+        return
+
+    def update(entry):
+        for res in results:
+            entry['hosts'].setdefault(res.host, {})[res.task] = res.end
+
+    _update(tag, update)
+
+
+def completed_hosts(tag, task):
+    ''' Returns the set of hosts that completed a given task in the run of a given tag.'''
+
+    return {host for host, tasks in journal_of(tag)['hosts'].items() if task in tasks}
+
+
+def assign_pids(tag, pids):
+    ''' Records pids of hosts of the run of a given tag, a dict host --> pid.'''
+
+    _update(tag, lambda entry: entry.__setitem__('pids', dict(pids)))
+
+
+def assigned_pids(tag):
+    ''' Returns dict host --> pid of hosts of the run of a given tag.'''
+
+    return journal_of(tag).get('pids', {})
+
+
+def forget_hosts(tag, hosts, keep_stages=(), redo_tasks=()):
+    '''
+    Drops tasks completed by given hosts, e.g. because they were terminated, together with completed
+    stages other than keep_stages, whose results (instances, ips) no longer hold. The run itself is
+    kept, so resuming it launches replacements and dispatches tasks only to hosts that did not complete them.
+    :param tuple keep_stages: stages that do not depend on the hosts, e.g. locally generated keys
+    :param tuple redo_tasks: tasks whose results depend on the whole fleet (e.g. its addresses), they
+        are forgotten on the remaining hosts too
+    '''
+
+    hosts = set(hosts)
+
+    def update(entry):
+        entry['hosts'] = {host: {task: end for task, end in tasks.items() if task not in redo_tasks}
+                          for host, tasks in entry['hosts'].items() if host not in hosts}
+        entry['stages'] = {stage: done for stage, done in entry['stages'].items() if stage in keep_stages}
+        entry['pids'] = {host: pid for host, pid in entry.get('pids', {}).items() if host not in hosts}
+
+    _update(tag, update)
+
@@ -0,0 +1,102 @@
+'''Persistent cache of regional aws metadata: ami, vpc and security group ids, uploaded key pairs.'''
+
+from utils import (create_security_group, file_lock, image_id_in_region, init_key_pair, read_json,
+                   security_group_by_name, use_regions, vpc_id_in_region, write_json_atomic)
+
+METADATA_PATH = '.aws_metadata.json'
+
+
+def _store(region_name, key, value):
+    with file_lock(METADATA_PATH):
+        metadata = read_json(METADATA_PATH, {})
+        metadata.setdefault(region_name, {})[key] = value
+        write_json_atomic(METADATA_PATH, metadata)
+
+
+def _cached(region_name, key, lookup):
+    '''
+    Returns the value cached under a given key for a given region. On a miss the value is looked
+    up with lookup() and stored, unless the lookup found nothing.
+    '''
+
+    value = read_json(METADATA_PATH, {}).get(region_name, {}).get(key)
+    if value is None:
+        value = lookup()
+        if value is not None:
+            _store(region_name, key, value)
+
+    return value
+
+
+def _local_fingerprint(key_name):
+    try:
+        with open(f'key_pairs/{key_name}.fingerprint', 'r') as f:
+            return f.readline()
+    except FileNotFoundError:
+        return None
+
+
+def cached_image_id(region_name, image_name='ubuntu'):
+    return _cached(region_name, f'image:{image_name}',
+                   lambda: image_id_in_region(region_name, image_name))
+
+
+def cached_vpc_id(region_name):
+    return _cached(region_name, 'vpc', lambda: vpc_id_in_region(region_name))
+
+
+def cached_security_group_id(region_name, tag=''):
+    def lookup():
+        sg = security_group_by_name(region_name, tag)
+        if sg is not None:
+            return sg['GroupId']
+        # it seems that the group does not exist, let fix that
+        return create_security_group(region_name, tag=tag, vpc_id=cached_vpc_id(region_name)).id
+
+    return _cached(region_name, f'sg:{tag}', lookup)
+
+
+def cached_key_pair(region_name, key_name='aleph'):
+    '''
+    Makes sure the local key pair is uploaded to a given region. The check is skipped if the
+    fingerprint of the local key was already confirmed there.
+    '''
+
+    key = f'key:{key_name}'
+    fingerprint = _local_fingerprint(key_name)
+    if fingerprint is not None and read_json(METADATA_PATH, {}).get(region_name, {}).get(key) == fingerprint:
+        return
+
+    init_key_pair(region_name, key_name)
+    # the key might have just been generated
+    _store(region_name, key, _local_fingerprint(key_name))
+
+
+def invalidate_metadata(regions=None, key=None):
+    '''
+    Drops cached metadata of given regions (all by default), only the entry under key if given.
+    Call it when a cached id turns out to be stale, e.g. after deleting a security group.
+    '''
+
+    with file_lock(METADATA_PATH):
+        metadata = read_json(METADATA_PATH, {})
+        for region_name in (list(metadata) if regions is None else regions):
+            if key is None:
+                metadata.pop(region_name, None)
+            else:
+                metadata.get(region_name, {}).pop(key, None)
+        write_json_atomic(METADATA_PATH, metadata)
+
+
+def refresh_metadata(regions=None, tags=(), image_name='ubuntu', key_name='aleph'):
+    ''' Drops cached metadata of given regions and looks everything up again.'''
+
+    regions = use_regions() if regions is None else regions
+
+    invalidate_metadata(regions)
+    for region_name in regions:
+        cached_key_pair(region_name, key_name)
+        cached_image_id(region_name, image_name)
+        cached_vpc_id(region_name)
+        for tag in tags:
+            cached_security_group_id(region_name, tag)
@@ -0,0 +1,84 @@
+'''Concurrent readiness probing of freshly launched machines.'''
+
+import socket
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import sleep, time
+
+from tracing import record
+
+READINESS_WORKERS = 64
+PROBE_TIMEOUT = 5
+
+
+def probe_ssh(ip, user='ubuntu', key_path='key_pairs/aleph.pem', port=22, delay=0):
+    '''
+    Checks once if a host accepts ssh connections: first a tcp connect and the ssh banner,
+    then the full key exchange and authentication.
+    :returns: True if the host is ready, False otherwise
+    '''
+
+    if delay:
+        sleep(delay)
+
+    try:
+        with socket.create_connection((ip, port), timeout=PROBE_TIMEOUT) as sock:
+            sock.settimeout(PROBE_TIMEOUT)
+            if not sock.recv(256).startswith(b'SSH-'):
+                return False
+    except OSError:
+        return False
+
+    import paramiko
+
+    client = paramiko.SSHClient()
+    client.set_missing_host_key_policy(paramiko.AutoAddPolicy())
+    try:
+        client.connect(ip, port, username=user, key_filename=key_path, timeout=PROBE_TIMEOUT,
+                       banner_timeout=PROBE_TIMEOUT, auth_timeout=PROBE_TIMEOUT,
+                       allow_agent=False, look_for_keys=False)
+        return True
+    except (OSError, paramiko.SSHException):
+        return False
+    finally:
+        client.close()
+
+
+def wait_ssh_ready(ips, timeout=600, interval=1, n_workers=READINESS_WORKERS, strict=True, **probe_kwargs):
+    '''
+    Probes all given hosts concurrently until every one of them accepts ssh or timeout passes.
+    Every probe attempt is a separate job, so a bounded pool serves any number of hosts.
+    Hosts without an ip (None, e.g. not assigned yet) are not probed and count as not ready.
+    :param list ips: ips of hosts to probe
+    :param int timeout: time in seconds after which hosts that are not ready are given up on
+    :param float interval: delay in seconds between consecutive probes of the same host
+    :param bool strict: indicates whether to raise RuntimeError if any host is not ready
+    :returns: dict ip --> time to ready in seconds, None for hosts that were given up on
+    '''
+
+    start = time()
+    without_ip = sum(1 for ip in ips if not ip)
+    ips = [ip for ip in ips if ip]
+    ready = {ip: None for ip in ips}
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(probe_ssh, ip, **probe_kwargs): ip for ip in ips}
+        while futures:
+            done, _ = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                ip = futures.pop(future)
+                if future.result():
+                    ready[ip] = time() - start
+                    record('ssh ready', start, time(), 'ssh', track=ip)
+                elif time() - start < timeout:
+                    futures[pool.submit(probe_ssh, ip, delay=interval, **probe_kwargs)] = ip
+
+    not_ready = [ip for ip, t in ready.items() if t is None]
+    if not_ready:
+        print(f'hosts not ready after {timeout}s:', *not_ready)
+    if without_ip:
+        print(f'{without_ip} hosts have no ip')
+    if not not_ready and not without_ip and ready:
+        print(f'all {len(ready)} hosts ready after {round(max(ready.values()), 2)}s')
+    if strict and (not_ready or without_ip):
+        raise RuntimeError(f'{len(not_ready) + without_ip} hosts are not ready to accept ssh')
+
+    return ready
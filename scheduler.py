@@ -0,0 +1,94 @@
+'''Runs a dependency graph of stages, every stage as soon as all its dependencies are done.'''
+
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import time
+
+from tracing import span
+
+Stage = namedtuple('Stage', ['name', 'func', 'deps'])
+StageTiming = namedtuple('StageTiming', ['name', 'start', 'end', 'deps'])
+
+
+def run_stages(stages, max_workers=8, done=None, on_done=None):
+    '''
+    Runs stages concurrently respecting dependencies.
+    :param list stages: list of Stage; func of a stage is called with a dict name --> result of
+        all stages finished so far, deps is a list of names of stages that have to finish first
+    :param dict done: name --> result of stages completed before (e.g. by an interrupted run), they are not run again
+    :param on_done: function called with the name and the result of every stage as soon as it finishes
+    :returns: pair (dict name --> result, dict name --> StageTiming), timings only of stages that were run
+    :raises: the first exception raised by a stage, after all running stages finish; stages
+        that were not started yet are skipped
+    '''
+
+    by_name = {stage.name: stage for stage in stages}
+    for stage in stages:
+        missing = [dep for dep in stage.deps if dep not in by_name]
+        assert not missing, f'stage {stage.name} depends on unknown stages {missing}'
+
+    results = {name: result for name, result in (done or {}).items() if name in by_name}
+    timings = {}
+    pending = [stage for stage in stages if stage.name not in results]
+    running = {}
+    error = None
+
+    def timed(stage, done):
+        start = time()
+        with span(stage.name, 'stage', track=f'stage {stage.name}'):
+            result = stage.func(done)
+        return result, start, time()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+            if error is None:
+                for stage in [s for s in pending if all(dep in results for dep in s.deps)]:
+                    pending.remove(stage)
+                    running[pool.submit(timed, stage, dict(results))] = stage
+            elif not running:
+                break
+
+            assert running, f'cyclic dependencies among stages {[s.name for s in pending]}'
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    results[stage.name], start, end = future.result()
+                    timings[stage.name] = StageTiming(stage.name, start, end, stage.deps)
+                    if on_done is not None:
+                        on_done(stage.name, results[stage.name])
+                except Exception as e:
+                    error = error or e
+
+    if error is not None:
+        raise error
+
+    return results, timings
+
+
+def critical_path(timings):
+    '''
+    Returns the chain of stages that bounded the total time: starting from the stage that finished
+    last, it follows the dependency that finished last.
+    '''
+
+    if not timings:
+        return []
+
+    path = [max(timings.values(), key=lambda t: t.end)]
+    # stages completed by an earlier run have no timings
+    while any(dep in timings for dep in path[-1].deps):
+        path.append(max((timings[dep] for dep in path[-1].deps if dep in timings), key=lambda t: t.end))
+
+    return path[::-1]
+
+
+def print_critical_path(timings):
+    if not timings:
+        return
+
+    t0 = min(t.start for t in timings.values())
+    print('critical path:')
+    for t in critical_path(timings):
+        print(f'  {t.name:24} {round(t.start - t0, 2):8}s -> {round(t.end - t0, 2):8}s  '
+              f'({round(t.end - t.start, 2)}s)')
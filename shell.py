@@ -1,27 +1,78 @@
 '''This is a shell for orchestrating experiments on AWS EC 2'''
 import os
+import random
 import shutil
+import uuid
 
+from collections import namedtuple
 from functools import partial
 from subprocess import run, call, Popen, PIPE
 from time import sleep, time
-from joblib import Parallel, delayed
-
-import boto3
 
 from utils import *
+from inventory import inventory_instances_in_region, invalidate_inventory, INVENTORY_STATES
+from readiness import wait_ssh_ready
+from tracing import traced, traced_run, export_trace, start_trace
+from dispatch import (run_task_on_hosts, run_task_with_parallel, run_pipeline_on_hosts, run_cmd_on_hosts,
+                      close_connections, print_task_summary, task_summary, DISPATCH_WORKERS, CMD_TIMEOUT)
+from scheduler import Stage, run_stages, print_critical_path
+from concurrency import configure_concurrency
+from artifacts import print_hops, seed_artifact
+from bundles import build_bundles, db_relay_url
+from snapshots import print_seed_results, seed_snapshot_to_hosts, take_snapshot
+from journal import assign_pids, assigned_pids, completed_hosts, completed_stages, forget_hosts, journal_of, stage_done, start_run, tasks_done
+from metadata import cached_image_id, cached_key_pair, cached_security_group_id, invalidate_metadata, refresh_metadata
 
 import warnings
-import yaml
 warnings.filterwarnings(action='ignore', module='.*paramiko.*')
 
-N_JOBS = 12
+# 'pool' runs fabfile tasks in this process over persistent ssh connections,
+# 'parallel' spawns a fab process per host with GNU parallel
+DISPATCH_ENGINE = 'pool'
+# 'seed' uploads files sent by tasks listed in SEED_ARTIFACTS once per region and lets a seed host
+# copy them to the rest of the region, 'direct' uploads them to every host from here
+ARTIFACT_FANOUT = 'seed'
+SEED_ARTIFACTS = {
+    'send-binary': ['bin/aleph-node'],
+    'send-new-binary': ['bin/aleph-node-new'],
+    'send-cli-binary': ['bin/cliain'],
+    'send-flooder-binary': ['bin/flooder'],
+    'send-data': ['chainspec.json'],
+    'send-chainspec': ['chainspec.json'],
+}
+# 'relay' downloads the testnet db backup once per region to a relay host that nodes of the region
+# stream it from, 'direct' makes every node stream it from the origin
+DB_SNAPSHOT_MODE = 'relay'
+LAUNCH_TRIES = 5
+LAUNCH_BACKOFF = 5
+# seconds to wait for public ips to be assigned before probing ssh
+PUBLIC_IP_TIMEOUT = 120
+# setup stages that only generate local files, they stay valid when hosts of the run are terminated
+LOCAL_STAGES = ('accounts', 'chainspec', 'node-keys')
+# tasks sending files built from addresses of the whole fleet, they are redone on every host when it changes
+FLEET_TASKS = ('send-data',)
+
+LaunchResult = namedtuple(
+    'LaunchResult', ['region', 'n_parties', 'instance_ids', 'attempts', 'latency', 'error'])
 
 # ======================================================================================
 #                              routines for ips
 # ======================================================================================
 
 
+def dispatch_task(task, ip_list, pids=None, parallel=True, regions=None):
+    '''
+    Runs a task from fabfile.py on given hosts with the engine selected by DISPATCH_ENGINE.
+    :returns: list of TaskResult, one per host
+    '''
+
+    if DISPATCH_ENGINE == 'pool':
+        return run_task_on_hosts(task, ip_list, pids, DISPATCH_WORKERS if parallel else 1, regions)
+
+    return run_task_with_parallel(task, ip_list, pids, parallel, regions)
+
+
+@traced()
 def run_task_for_ip(task='test', ip_list=[], parallel=True, pids=None):
     '''
     Runs a task from fabfile.py on all instances in a given region.
@@ -32,22 +83,7 @@ def run_task_for_ip(task='test', ip_list=[], parallel=True, pids=None):
 
     print(f'running task {task} in {ip_list}')
 
-    if parallel:
-        hosts = " ".join(["ubuntu@"+ip for ip in ip_list])
-        pcmd = f'parallel {fab_cmd()} -H'
-        if pids is None:
-            cmd = pcmd + ' {} ' + task + ' ::: ' + hosts
-        else:
-            cmd = pcmd + ' {1} ' + task + ' --pid={2} ::: ' + \
-                hosts + ' :::+ ' + ' '.join(pids)
-    else:
-        hosts = ",".join(["ubuntu@"+ip for ip in ip_list])
-        cmd = f'{fab_cmd()} -H {hosts} {task}'
-
-    try:
-        return run(cmd.split(), capture_output=True)
-    except Exception as _:
-        print('paramiko troubles')
+    return dispatch_task(task, ip_list, pids, parallel)
 
 # ======================================================================================
 #                              routines for some region
@@ -55,11 +91,17 @@ def run_task_for_ip(task='test', ip_list=[], parallel=True, pids=None):
 
 
 def create_instances(region_name, image_id, n_parties, instance_type, key_name,
-                     security_group_id, volume_size, tag):
-    ''' Creates instances. '''
+                     security_group_id, volume_size, tag, client_token=None):
+    '''
+    Creates instances.
+    :param string client_token: idempotency token, a repeated call with the same token returns instances
+        created by the first one instead of creating new ones
+    '''
 
-    ec2 = boto3.resource('ec2', region_name)
-    instances = ec2.create_instances(ImageId=image_id,
+    ec2 = ec2_resource(region_name)
+    kwargs = {} if client_token is None else {'ClientToken': client_token}
+    instances = ec2.create_instances(**kwargs,
+                                     ImageId=image_id,
                                      MinCount=n_parties,
                                      MaxCount=n_parties,
                                      InstanceType=instance_type,
@@ -86,71 +128,81 @@ def create_instances(region_name, image_id, n_parties, instance_type, key_name,
     return instances
 
 
-def launch_new_instances_in_region(n_parties=1, region_name=default_region(),
-                                   instance_type='t2.micro', volume_size=8, tag='dev'):
-    '''Launches n_parties in a given region.'''
+@traced()
+def launch_new_instances_in_region(n_parties=1, region_name=None,
+                                   instance_type='t2.micro', volume_size=8, tag='dev', client_token=None):
+    '''Launches n_parties in a given region. See create_instances for client_token.'''
+
+    region_name = region_name or default_region()
 
     print('launching instances in', region_name)
 
-    init_key_pair(region_name)
-    security_group_id = security_group_id_by_region(region_name, tag)
-    image_id = image_id_in_region(region_name, 'ubuntu')
+    cached_key_pair(region_name)
+    security_group_id = cached_security_group_id(region_name, tag)
+    image_id = cached_image_id(region_name, 'ubuntu')
 
-    return create_instances(region_name, image_id, n_parties, instance_type, 'aleph',
-                            security_group_id, volume_size, tag)
+    instances = create_instances(region_name, image_id, n_parties, instance_type, 'aleph',
+                                 security_group_id, volume_size, tag, client_token)
+    invalidate_inventory(tag, [region_name])
 
+    return instances
 
-def all_instances_in_region(region_name=default_region(), states=['running', 'pending'],
-                            tag='dev'):
-    '''Returns all running or pending instances in a given region.'''
 
-    ec2 = boto3.resource('ec2', region_name)
-    instances = []
-    for instance in ec2.instances.all():
-        if instance.state['Name'] in states:
-            it = instance.tags
-            if (it is None and tag == '') or (it is not None and it[0]['Key'] == 'net' and it[0]['Value'] == tag):
-                instances.append(instance)
+def all_instances_in_region(region_name=None, states=['running', 'pending'],
+                            tag='dev', cached=True):
+    '''
+    Returns records of all running or pending instances in a given region.
+    :param bool cached: indicates whether records may be served from the local fleet inventory
+    '''
 
-    return instances
+    region_name = region_name or default_region()
+
+    if cached and set(states) == set(INVENTORY_STATES):
+        return inventory_instances_in_region(region_name, tag)
+
+    return describe_tagged_instances(region_name, tag, states)
 
 
-def terminate_instances_in_region(region_name=default_region(), tag='dev'):
+@traced()
+def terminate_instances_in_region(region_name=None, tag='dev'):
     '''Terminates all running instances in a given regions.'''
 
+    region_name = region_name or default_region()
+
     ans = input(
         f"Do you want to terminate all instances in region {region_name} tagged {tag} [y]/n?")
     if ans not in ['', 'y']:
         return
 
     print(region_name, 'terminating instances')
-    for instance in all_instances_in_region(region_name, tag=tag):
-        instance.terminate()
-
+    instances = all_instances_in_region(region_name, tag=tag, cached=False)
+    ids = [instance.id for instance in instances]
+    ec2 = ec2_client(region_name)
+    for i in range(0, len(ids), 1000):
+        ec2.terminate_instances(InstanceIds=ids[i:i+1000])
+    invalidate_inventory(tag, [region_name])
+    if ids:
+        # the journal must not describe hosts that are gone now
+        forget_hosts(tag, [instance.public_ip for instance in instances], LOCAL_STAGES, FLEET_TASKS)
 
-def instances_ip_in_region(region_name=default_region(), tag='dev'):
-    '''Returns ips of all running or pending instances in a given region.'''
+    return ids
 
-    ips = []
 
-    for instance in all_instances_in_region(region_name, tag=tag):
-        ips.append(instance.public_ip_address)
+def instances_ip_in_region(region_name=None, tag='dev'):
+    '''Returns ips of all running or pending instances in a given region.'''
 
-    return ips
+    return [instance.public_ip for instance in all_instances_in_region(region_name, tag=tag)]
 
 
-def instances_state_in_region(region_name=default_region(), tag='dev'):
+def instances_state_in_region(region_name=None, tag='dev'):
     '''Returns states of all instances in a given regions.'''
 
-    states = []
     possible_states = ['running', 'pending', 'shutting-down', 'terminated']
-    for instance in all_instances_in_region(region_name, possible_states, tag=tag):
-        states.append(instance.state['Name'])
-
-    return states
+    return [instance.state for instance in all_instances_in_region(region_name, possible_states, tag=tag)]
 
 
-def run_task_in_region(task='test', region_name=default_region(), parallel=True, tag='dev', pids=None):
+@traced()
+def run_task_in_region(task='test', region_name=None, parallel=True, tag='dev', pids=None):
     '''
     Runs a task from fabfile.py on all instances in a given region.
     :param string task: name of a task defined in fabfile.py
@@ -158,83 +210,70 @@ def run_task_in_region(task='test', region_name=default_region(), parallel=True,
     :param bool parallel: indicates whether task should be dispatched in parallel
     '''
 
+    region_name = region_name or default_region()
+
     print(f'running task {task} in {region_name}')
 
     # this function doesn't actually work for multiple regions
     # and is unlikely to work in general
     # so it fits perfectly with the code 'round here...
     # edit: now it works :)
-    ip_list = instances_ip_in_region(region_name, tag)
-    if parallel:
-        hosts = " ".join(["ubuntu@"+ip for ip in ip_list])
-        pcmd = f'parallel {fab_cmd()} -H'
-        if pids is None:
-            cmd = pcmd + ' {} ' + task + ' ::: ' + hosts
-        else:
-            pids = [str(pid) for pid in pids]
-            cmd = pcmd + ' {1} ' + task + ' --pid={2} ::: ' + \
-                hosts + ' :::+ ' + ' '.join(pids)
+    if isinstance(pids, dict):
+        ip_list, pids = list(pids), list(pids.values())
     else:
-        hosts = ",".join(["ubuntu@"+ip for ip in ip_list])
-        cmd = f'{fab_cmd()} -H {hosts} {task}'
-
-    try:
-        return run(cmd.split(), capture_output=True)
-    except Exception as _:
-        print('paramiko troubles')
+        ip_list = instances_ip_in_region(region_name, tag)
+    return dispatch_task(task, ip_list, pids, parallel, [region_name] * len(ip_list))
 
 
-def run_cmd_in_region(shcmd='ls', region_name=default_region(), tag='dev'):
+@traced()
+def run_cmd_in_region(shcmd='ls', region_name=None, tag='dev', stream=True, timeout=CMD_TIMEOUT):
     '''
-    Runs a shell command cmd on all instances in a given region.
+    Runs a shell command cmd on all instances in a given region concurrently.
     :param string cmd: a shell command that is run on instances
     :param string region_name: region from which instances are picked
-    :param bool output: indicates whether output of cmd is needed
+    :param bool stream: indicates whether output should be printed live, each line tagged with the host
+    :param int timeout: time in seconds after which the command is killed on a host
+    :returns: list of CmdResult with exit status, stdout and stderr of every host
     '''
 
+    region_name = region_name or default_region()
+
     print(f'running command {shcmd} in {region_name}')
 
     ip_list = instances_ip_in_region(region_name, tag)
-    results = []
-    for ip in ip_list:
-        cmd = f'ssh -o "StrictHostKeyChecking no" -q -i key_pairs/aleph.pem ubuntu@{ip} -t "{shcmd}"'
-        results.append(call(cmd, shell=True))
 
-    return results
+    return run_cmd_on_hosts(shcmd, ip_list, [region_name] * len(ip_list), timeout, stream)
 
 
-def allow_traffic_in_region(region_name=default_region(), ip_list=[], tag='dev'):
+def allow_traffic_in_region(region_name=None, ip_list=[], tag='dev'):
     '''Updates security group with addresses in given ip_list.'''
 
+    region_name = region_name or default_region()
+
     update_security_group(region_name, ip_list, tag)
 
 
-def wait_in_region(target_state, region_name=default_region(), tag='dev'):
+@traced()
+def wait_in_region(target_state, region_name=None, tag='dev'):
     '''Waits until all machines in a given region reach a given state.'''
 
+    region_name = region_name or default_region()
+
     print('waiting in', region_name)
 
-    instances = all_instances_in_region(region_name, tag=tag)
-    if target_state == 'running':
-        for i in instances:
-            i.wait_until_running()
-    elif target_state == 'terminated':
-        for i in instances:
-            i.wait_until_terminated()
+    instances = all_instances_in_region(region_name, tag=tag, cached=False)
+    ids = [instance.id for instance in instances]
+    if target_state in ['running', 'terminated'] and ids:
+        waiter = ec2_client(region_name).get_waiter(f'instance_{target_state}')
+        waiter.wait(InstanceIds=ids)
+        # public ips are assigned on the way to running, so cached records are stale now
+        invalidate_inventory(tag, [region_name])
     elif target_state == 'open 22':
-        for i in instances:
-            cmd = f'{fab_cmd()} -H ubuntu@{i.public_ip_address} test'
-            while run(cmd.split(), capture_output=True).returncode != 0:
-                sleep(.1)
-                print('.', end='')
-        print()
-        sleep(10)
+        return wait_ssh_ready(wait_public_ips([region_name], tag))
     if target_state == 'ssh ready':
-        ids = [instance.id for instance in instances]
         initializing = True
         while initializing:
-            responses = boto3.client(
-                'ec2', region_name).describe_instance_status(InstanceIds=ids)
+            responses = ec2_client(region_name).describe_instance_status(InstanceIds=ids)
             statuses = responses['InstanceStatuses']
             all_initialized = True
             if statuses:
@@ -252,15 +291,15 @@ def wait_in_region(target_state, region_name=default_region(), tag='dev'):
         print()
 
 
-def wait_install_in_region(type, region_name=default_region(), tag='dev'):
+@traced()
+def wait_install_in_region(type, region_name=None, tag='dev'):
     '''Checks if installation has finished on all instances in a given region.'''
 
-    results = []
+    region_name = region_name or default_region()
+
     cmd = f"tail -1 {type}_setup.log"
-    run(cmd.split(), capture_output=True)
-    results = run_cmd_in_region(cmd, region_name, tag)
-    for result in results:
-        if len(result) < 4 or result[:4] != b'done':
+    for result in run_cmd_in_region(cmd, region_name, tag, stream=False):
+        if not result.stdout.startswith('done'):
             return False
 
     print(f'installation in {region_name} finished')
@@ -271,17 +310,47 @@ def wait_install_in_region(type, region_name=default_region(), tag='dev'):
 # ======================================================================================
 
 
-def exec_for_regions(func, regions=use_regions(), parallel=True, pids=None):
-    '''A helper function for running routines in all regions.'''
+def hosts_in_regions(regions, tag='dev', pids=None):
+    '''
+    Returns three lists of the same length: ips of all instances in given regions, their pids
+    (None if pids are not given) and their regions.
+    :param dict pids: dict region_name --> dict ip --> pid of instances in the region (then the hosts are
+        exactly these ips), or dict region_name --> list of pids in the order instances are listed by aws
+    '''
+
+    hosts, host_pids, host_regions = [], [], []
+    for region_name in regions:
+        if pids is not None and isinstance(pids[region_name], dict):
+            hosts += list(pids[region_name])
+            host_pids += list(pids[region_name].values())
+            host_regions += [region_name] * len(pids[region_name])
+            continue
+        ip_list = instances_ip_in_region(region_name, tag)
+        hosts += ip_list
+        host_pids += pids[region_name] if pids is not None else [None] * len(ip_list)
+        host_regions += [region_name] * len(ip_list)
+
+    return hosts, host_pids, host_regions
+
+
+def exec_for_regions(func, regions=None, parallel=True, pids=None):
+    '''
+    A helper function for running routines in all regions. Regions run in threads of this process,
+    so their aws calls share pooled clients and the adaptive 'ec2' concurrency limit.
+    '''
+
+    regions = use_regions() if regions is None else regions
 
     results = []
     if parallel:
+        from joblib import Parallel, delayed
+
         try:
             if pids is None:
-                results = Parallel(n_jobs=N_JOBS)(
+                results = Parallel(n_jobs=max(1, len(regions)), prefer='threads')(
                     delayed(func)(region_name) for region_name in regions)
             else:
-                results = Parallel(n_jobs=N_JOBS)(delayed(func)(
+                results = Parallel(n_jobs=max(1, len(regions)), prefer='threads')(delayed(func)(
                     region_name, pids=pids[region_name]) for region_name in regions)
 
         except Exception as e:
@@ -296,89 +365,256 @@ def exec_for_regions(func, regions=use_regions(), parallel=True, pids=None):
     return results
 
 
+@traced()
+def launch_in_region_with_retry(region_name, n_parties, instance_type='t2.micro', volume_size=8,
+                                tag='dev', tries=LAUNCH_TRIES, backoff=LAUNCH_BACKOFF):
+    '''
+    Launches n_parties in a given region, retrying failed attempts with jittered exponential backoff.
+    All attempts share one client token, so a retry of a call that created instances but did not
+    return (e.g. timed out) gets those instances instead of launching another set.
+    :returns: LaunchResult with ids of created instances, number of attempts, latency in seconds
+        and the last error (None on success)
+    '''
+
+    start = time()
+    error = None
+    client_token = str(uuid.uuid4())
+    for attempt in range(1, tries + 1):
+        try:
+            instances = launch_new_instances_in_region(
+                n_parties, region_name, instance_type, volume_size, tag, client_token)
+            if instances:
+                return LaunchResult(region_name, n_parties, [i.id for i in instances],
+                                    attempt, time() - start, None)
+            error = 'no instances were created'
+        except Exception as e:
+            error = f'{type(e).__name__}: {e}'
+            # the failure might be caused by a stale cached ami or security group id
+            invalidate_metadata([region_name])
+
+        if attempt < tries:
+            # full jitter keeps retries from different regions from hitting aws in lockstep
+            sleep(random.uniform(0, backoff * 2 ** (attempt - 1)))
+
+    return LaunchResult(region_name, n_parties, [], tries, time() - start, error)
+
+
+@traced()
 def launch_new_instances(nppr, instance_type='t2.micro', volume_size=8, tag='dev'):
     '''
-    Launches n_parties_per_region in ever region from given regions.
+    Launches n_parties_per_region in every region from given regions. Regions are provisioned
+    concurrently, each one retrying independently.
     :param dict nppr: dict region_name --> n_parties_per_region
+    :returns: list of LaunchResult, one per region
     '''
 
-    regions = nppr.keys()
+    from joblib import Parallel, delayed
 
-    failed = []
     print('launching instances')
-    for region_name in regions:
-        print(region_name, '', end='')
-        instances = launch_new_instances_in_region(
-            nppr[region_name], region_name, instance_type, volume_size, tag)
-        if not instances:
-            failed.append(region_name)
-
-    tries = 5
-    while failed and tries:
-        tries -= 1
-        sleep(5)
-        print('there were problems in launching instances in regions',
-              *failed, 'retrying')
-        for region_name in failed.copy():
-            print(region_name, '', end='')
-            instances = launch_new_instances_in_region(
-                nppr[region_name], region_name, instance_type, volume_size, tag)
-            if instances:
-                failed.remove(region_name)
+    # regions below only check the key is uploaded, the key itself is generated here
+    ensure_local_key_pair()
+    results = Parallel(n_jobs=max(1, len(nppr)), prefer='threads')(
+        delayed(launch_in_region_with_retry)(region_name, n_parties, instance_type, volume_size, tag)
+        for region_name, n_parties in nppr.items())
 
+    invalidate_inventory(tag, list(nppr))
+
+    failed = [res.region for res in results if res.error is not None]
     if failed:
         print('reporting complete failure in regions', failed)
 
+    return results
+
 
-def terminate_instances(regions=use_regions(), parallel=True, tag='dev'):
+def terminate_instances(regions=None, parallel=True, tag='dev'):
     '''Terminates all instances in ever region from given regions.'''
 
     return exec_for_regions(partial(terminate_instances_in_region, tag=tag), regions, parallel)
 
 
-def all_instances(regions=use_regions(), states=['running', 'pending'], parallel=True, tag='dev'):
+def all_instances(regions=None, states=['running', 'pending'], parallel=True, tag='dev'):
     '''Returns all running or pending instances from given regions.'''
 
     return exec_for_regions(partial(all_instances_in_region, states=states, tag=tag), regions, parallel)
 
 
-def instances_ip(regions=use_regions(), parallel=True, tag='dev'):
+def instances_ip(regions=None, parallel=True, tag='dev'):
     '''Returns ip addresses of all running or pending instances from given regions.'''
 
     return exec_for_regions(partial(instances_ip_in_region, tag=tag), regions, parallel)
 
 
-def instances_state(regions=use_regions(), parallel=True, tag='dev'):
+def instances_state(regions=None, parallel=True, tag='dev'):
     '''Returns states of all instances in given regions.'''
 
     return exec_for_regions(partial(instances_state_in_region, tag=tag), regions, parallel)
 
 
-def run_task(task='test', regions=use_regions(), parallel=True, tag='dev', pids=None):
+def db_relays(regions=None, tag='dev'):
+    ''' Returns dict region_name --> record of the instance relaying the testnet db backup to the region.'''
+
+    regions = use_regions() if regions is None else regions
+
+    relays = {}
+    for region_name in regions:
+        instances = all_instances_in_region(region_name, tag=tag)
+        if instances:
+            relays[region_name] = min(instances, key=lambda instance: instance.id)
+
+    return relays
+
+
+@traced()
+def fetch_db_snapshot(regions=None, tag='dev'):
+    '''
+    Downloads the testnet db backup to the relay host of every given region, with parallel resumable
+    range requests, and starts serving it to the other hosts of the region over the private network.
+    :returns: list of TaskResult, one per relay
+    '''
+
+    relays = db_relays(regions, tag)
+    results = dispatch_task('fetch-db-snapshot', [r.public_ip for r in relays.values()], None, True, list(relays))
+    print_task_summary(results)
+
+    return results
+
+
+@traced()
+def seed_artifacts_in_region(paths, region_name=None, tag='dev'):
+    ''' Sends local files to all instances in a given region, uploading each of them from here at most once.'''
+
+    region_name = region_name or default_region()
+
+    hosts = [(r.public_ip, r.private_ip) for r in all_instances_in_region(region_name, tag=tag)]
+    return [hop for path in paths for hop in seed_artifact(path, hosts, region=region_name)]
+
+
+@traced()
+def seed_artifacts(paths, regions=None, tag='dev'):
+    '''
+    Sends local files to all instances in all given regions: every file is uploaded to one seed
+    host per region, which copies it to the other hosts of the region over the private network.
+    Prints throughput of uploads and of copies within every region.
+    :returns: list of Hop, one per copy
+    '''
+
+    hops = exec_for_regions(partial(seed_artifacts_in_region, paths, tag=tag), regions)
+    print_hops(hops)
+
+    return hops
+
+
+def seed_artifacts_for_tasks(tasks, regions=None, tag='dev'):
+    '''
+    Seeds files sent by given tasks (see SEED_ARTIFACTS) if ARTIFACT_FANOUT is 'seed', so the tasks
+    find them in place. If seeding fails, the tasks upload the files to every host themselves.
+    '''
+
+    paths = list(dict.fromkeys(path for task in tasks for path in SEED_ARTIFACTS.get(task, [])))
+    if ARTIFACT_FANOUT != 'seed' or not paths:
+        return
+
+    try:
+        seed_artifacts(paths, regions, tag)
+    except Exception as e:
+        print(f'seeding {paths} failed, they are uploaded to every host instead: {type(e).__name__}: {e}')
+
+
+@traced()
+def run_task(task='test', regions=None, parallel=True, tag='dev', pids=None, journaled=False):
     '''
     Runs a task from fabfile.py on all instances in all given regions.
     :param string task: name of a task defined in fabfile.py
     :param list regions: collections of regions in which the tast should be performed
     :param bool parallel: indicates whether task should be dispatched in parallel
+    :param bool journaled: indicates whether hosts that completed the task according to the journal
+        of tag should be skipped, and hosts that complete it now recorded there
     '''
 
+    # the task finds seeded files already in place and does not upload them again
+    seed_artifacts_for_tasks([task], regions, tag)
+
+    if DISPATCH_ENGINE == 'pool' or journaled:
+        # all regions share one pool of connections and workers
+        regions = use_regions() if regions is None else regions
+        print(f'running task {task} in', *regions)
+        hosts, host_pids, host_regions = hosts_in_regions(regions, tag, pids)
+        if not journaled:
+            return dispatch_task(task, hosts, host_pids, parallel, host_regions)
+
+        completed = completed_hosts(tag, task)
+        if completed:
+            print(f'task {task} already completed on {len(completed & set(hosts))} hosts')
+        todo = [i for i, host in enumerate(hosts) if host not in completed]
+        results = dispatch_task(task, [hosts[i] for i in todo], [host_pids[i] for i in todo], parallel,
+                                [host_regions[i] for i in todo])
+        tasks_done(tag, results)
+        return results
+
     return exec_for_regions(partial(run_task_in_region, task,
                                     parallel=parallel, tag=tag), regions, parallel, pids)
 
 
-def run_cmd(cmd='ls', regions=use_regions(), parallel=True, tag='dev'):
+@traced()
+def run_pipeline(phases, regions=None, tag='dev', pids=None, limits=None, journaled=False):
+    '''
+    Runs tasks from fabfile.py on all instances in all given regions, every host moving to its next
+    task as soon as it finishes the previous one. Falls back to running the tasks one by one on
+    the whole fleet if DISPATCH_ENGINE is not 'pool'. Files of tasks in SEED_ARTIFACTS are seeded
+    before those tasks run; as seeding needs packages installed by setup, hosts wait for setup to
+    finish on the whole fleet first.
+    :param list phases: names of tasks in the order they should run on every host
+    :param dict limits: task --> max number of hosts running it at once
+    :param bool journaled: indicates whether tasks completed according to the journal of tag should be
+        skipped, and tasks completed now recorded there
     '''
-    Runs a shell command cmd on all instances in all given regions.
+
+    regions = use_regions() if regions is None else regions
+
+    if DISPATCH_ENGINE != 'pool':
+        return [res for phase in phases for res in run_task(phase, regions, True, tag, pids, journaled)]
+
+    hosts, host_pids, host_regions = hosts_in_regions(regions, tag, pids)
+    done = journal_of(tag)['hosts'] if journaled else None
+    on_result = (lambda res: tasks_done(tag, [res])) if journaled else None
+
+    if ARTIFACT_FANOUT != 'seed' or not any(phase in SEED_ARTIFACTS for phase in phases):
+        return run_pipeline_on_hosts(phases, hosts, host_pids, host_regions, limits, done, on_result)
+
+    split = phases.index('setup') + 1 if 'setup' in phases else 0
+    results = run_pipeline_on_hosts(phases[:split], hosts, host_pids, host_regions, limits, done, on_result)
+    seed_artifacts_for_tasks(phases[split:], regions, tag)
+
+    # hosts that failed setup stop there, as they would in a single pipeline
+    failed = {res.host for res in results if res.exit_status != 0}
+    rest = [i for i, host in enumerate(hosts) if host not in failed]
+    results += run_pipeline_on_hosts(phases[split:], [hosts[i] for i in rest], [host_pids[i] for i in rest],
+                                     [host_regions[i] for i in rest], limits, done, on_result)
+
+    return results
+
+
+@traced()
+def run_cmd(cmd='ls', regions=None, parallel=True, tag='dev', stream=True, timeout=CMD_TIMEOUT):
+    '''
+    Runs a shell command cmd on all instances in all given regions, all hosts at once.
     :param string cmd: a shell command that is run on instances
     :param list regions: collections of regions in which the tast should be performed
-    :param bool parallel: indicates whether task should be dispatched in parallel
-    :param bool output: indicates whether output of task is needed
+    :param bool parallel: indicates whether the command should run on many hosts at once
+    :param bool stream: indicates whether output should be printed live, each line tagged with the host
+    :param int timeout: time in seconds after which the command is killed on a host
+    :returns: list of CmdResult with exit status, stdout and stderr of every host
     '''
 
-    return exec_for_regions(partial(run_cmd_in_region, cmd, tag=tag), regions, parallel)
+    regions = use_regions() if regions is None else regions
+    print(f'running command {cmd} in', *regions)
 
+    hosts, _, host_regions = hosts_in_regions(regions, tag)
+    return run_cmd_on_hosts(cmd, hosts, host_regions, timeout, stream, DISPATCH_WORKERS if parallel else 1)
 
-def allow_traffic(regions=use_regions(), ip_list=[], parallel=True, tag='dev'):
+
+@traced()
+def allow_traffic(regions=None, ip_list=[], parallel=True, tag='dev'):
     '''
     Adds ip_list to security group enabling traffic among instances.
     :param list ip_list: list of all allowed ips
@@ -389,25 +625,51 @@ def allow_traffic(regions=use_regions(), ip_list=[], parallel=True, tag='dev'):
                      ip_list=ip_list, tag=tag), regions, parallel)
 
 
-def allow_all_traffic(regions=use_regions(), tag='dev'):
+@traced()
+def allow_all_traffic(regions=None, tag='dev'):
     exec_for_regions(partial(allow_all_traffic_in_region,
                      tag=tag), regions, False)
 
 
-def wait(target_state, regions=use_regions(), tag='dev'):
-    '''Waits until all machines in all given regions reach a given state.'''
+@traced()
+def wait(target_state, regions=None, tag='dev'):
+    '''
+    Waits until all machines in all given regions reach a given state.
+    For 'open 22' all hosts are probed at once and a dict ip --> time to ready is returned.
+    '''
+
+    if target_state == 'open 22':
+        return wait_ssh_ready(wait_public_ips(regions, tag))
 
     exec_for_regions(partial(wait_in_region, target_state, tag=tag), regions)
 
 
-def wait_install(type, regions=use_regions(), tag='dev'):
+def wait_public_ips(regions=None, tag='dev', timeout=PUBLIC_IP_TIMEOUT):
+    '''
+    Returns public ips of all instances in given regions, waiting up to timeout seconds until every
+    instance has one. Instances still without a public ip are returned as None.
+    '''
+
+    start = time()
+    while True:
+        # regions with instances missing public ips are never cached, so every call asks aws anew
+        ip_list = instances_ip(regions, True, tag)
+        if all(ip_list) or time() - start > timeout:
+            return ip_list
+        sleep(2)
+
+
+@traced()
+def wait_install(type, regions=None, tag='dev'):
     '''Waits till installation finishes in all given regions.'''
 
+    regions = use_regions() if regions is None else regions
+
     while True:
         all_completed = True
 
         for r in regions:
-            if wait_install_in_region(type, r, tag):
+            if not wait_install_in_region(type, r, tag):
                 all_completed = False
                 sleep(.5)
         if all_completed:
@@ -432,6 +694,7 @@ ti = terminate_instances
 # ======================================================================================
 
 
+@traced_run
 def upgrade_binary(regions, tag='dev', delay=0):
     for ip in instances_ip(regions, 1, tag):
         run_task_for_ip('upgrade-binary', [ip], 0)
@@ -441,11 +704,48 @@ def upgrade_binary(regions, tag='dev', delay=0):
             input("to proceed, press any key")
 
 
+def _pid_lines(path):
+    with open(path, 'r') as f:
+        return [line.strip() for line in f.readlines()]
+
+
+@traced_run
+def snapshot_chain(pid='0', chain=None, restart=True):
+    '''
+    Takes a snapshot of the database of the node of a given pid, see snapshots.py. The node is
+    stopped only while its database is copied on its own disk; subsequent snapshots fetch only changed files.
+    :returns: name of the snapshot
+    '''
+
+    return take_snapshot(_pid_lines('addresses')[int(pid)], _pid_lines('validator_accounts')[int(pid)], chain, restart)
+
+
+@traced_run
+def seed_from_snapshot(pids=None, chain=None, name=None, restart=True):
+    '''
+    Seeds databases of nodes of given pids from a snapshot, so they do not sync from genesis. Nodes
+    that are running are stopped for that time and started again if restart is set. Only files
+    a node does not have are sent.
+    :param list pids: pids of nodes, all nodes listed in addresses by default
+    :param string name: name of the snapshot, the newest one by default
+    :returns: list of SeedResult
+    '''
+
+    addresses, auths = _pid_lines('addresses'), _pid_lines('validator_accounts')
+    pids = range(len(addresses)) if pids is None else [int(pid) for pid in pids]
+    results = seed_snapshot_to_hosts([addresses[pid] for pid in pids], [auths[pid] for pid in pids],
+                                     chain, name, restart)
+    print_seed_results(results)
+
+    return results
+
+
 def prepare_accounts(region, tag):
     ip = instances_ip_in_region(region, tag)[0]
     run_task_for_ip('prepare-accounts', [ip], False)
 
 
+@traced_run
 def setup_flooder(n_flooders, regions, instance_type, tag):
     flood_tag = tag+"-flood"
 
@@ -464,74 +764,177 @@ def setup_flooder(n_flooders, regions, instance_type, tag):
     allow_traffic(regions, ip_list, True, tag)
 
 
-def setup_infrastructure(n_parties, chain='dev', regions=use_regions(), instance_type='t2.micro',
-                         volume_size=8, tag='dev', benchmark_config=None, terminate_in_min=None, n_validators=None, **chain_flags):
+@traced_run
+def setup_infrastructure(n_parties, chain='dev', regions=None, instance_type='t2.micro',
+                         volume_size=8, tag='dev', benchmark_config=None, terminate_in_min=None, n_validators=None,
+                         pipelined=False, extra_phases=(), resume=False, bundle_dispatch=False, **chain_flags):
+    '''
+    Launches machines and prepares them to run nodes. Tasks listed in extra_phases run on every host
+    after the setup ones. If pipelined is set, every host goes through all its tasks on its own
+    instead of waiting for the whole fleet to finish each task.
+    Completed stages and tasks are recorded in the journal of tag. With resume set, the journal is
+    continued instead of started anew, so stages and tasks that completed before are skipped.
+    Per-pid bundles sent by send-data are built locally before dispatch; with bundle_dispatch set
+    they include dispatch scripts, which needs node_flags.json (and bootnodes for testnet).
+    '''
+
+    regions = use_regions() if regions is None else regions
+
+    if not resume:
+        start_run(tag, 'setup_infrastructure', dict(
+            n_parties=n_parties, chain=chain, regions=regions, instance_type=instance_type,
+            volume_size=volume_size, tag=tag, benchmark_config=benchmark_config, terminate_in_min=terminate_in_min,
+            n_validators=n_validators, pipelined=pipelined, extra_phases=list(extra_phases),
+            bundle_dispatch=bundle_dispatch, **chain_flags))
+
     n_validators = n_validators or n_parties
     start = time()
     parallel = n_parties > 1
-
-    color_print('launching machines')
     nhpr = n_parties_per_regions(n_parties, regions)
-    launch_new_instances(nhpr, instance_type, volume_size, tag)
 
-    color_print('waiting for transition from pending to running')
-    wait('running', regions, tag)
-
-    color_print('generating keys & addresses files')
-    pids, ip2pid, ip_list, c = {}, {}, [], 0
-    for r in regions:
-        ipl = instances_ip_in_region(r, tag)
-        pids[r] = [str(pid) for pid in range(c, c + len(ipl))]
-        ip2pid.update({ip: pid for (ip, pid) in zip(ipl, pids[r])})
-        c += len(ipl)
-        ip_list.extend(ipl)
-
-    allow_all_traffic(regions, tag)
-
-    write_addresses(ip_list)
-
-    os.makedirs('data', exist_ok=True)
-
-    parties = generate_accounts(
-        n_parties, chain, 'validator_phrases', 'validator_accounts')
-    if chain != 'testnet':
-        color_print('Generating chainspec')
-        bootstrap_chain(parties[:n_validators], chain,
-                        benchmark_config=benchmark_config, rich_accounts=parties[n_validators:], **chain_flags)
-        bootstrap_nodes(parties[n_validators:], chain, **chain_flags)
+    # local key and chainspec generation does not depend on ips, so it runs while machines boot
+
+    def launch(done):
+        # instances left by an interrupted run are kept, only the missing ones are launched
+        missing = {r: n - len(all_instances_in_region(r, tag=tag, cached=False)) for r, n in nhpr.items()}
+        missing = {r: n for r, n in missing.items() if n > 0}
+        if not missing:
+            return []
+        color_print('launching machines')
+        results = launch_new_instances(missing, instance_type, volume_size, tag)
+        failed = [res.region for res in results if res.error is not None]
+        if failed:
+            raise RuntimeError(f'launching instances failed in regions {failed}')
+        return results
+
+    def running(done):
+        color_print('waiting for transition from pending to running')
+        wait('running', regions, tag)
+
+    def collect_ips(done):
+        # hosts that got a pid before keep it, aws lists instances in no particular order
+        previous = assigned_pids(tag)
+        ips = {r: instances_ip_in_region(r, tag) for r in regions}
+        n_hosts = sum(len(ipl) for ipl in ips.values())
+        kept = {previous[ip] for ipl in ips.values() for ip in ipl if ip in previous}
+        free = iter(pid for pid in map(str, range(n_hosts)) if pid not in kept)
+        pids = {r: {ip: previous[ip] if ip in previous else next(free) for ip in ipl} for r, ipl in ips.items()}
+        host_pids = {ip: pid for region_pids in pids.values() for ip, pid in region_pids.items()}
+        assign_pids(tag, host_pids)
+        write_addresses(sorted(host_pids, key=lambda ip: int(host_pids[ip])))
+        return pids
+
+    def accounts(done):
+        color_print('generating keys & addresses files')
+        os.makedirs('data', exist_ok=True)
+        return generate_accounts(n_parties, chain, 'validator_phrases', 'validator_accounts')
+
+    def chainspec(done):
+        parties = done['accounts']
+        if chain != 'testnet':
+            color_print('Generating chainspec')
+            bootstrap_chain(parties[:n_validators], chain,
+                            benchmark_config=benchmark_config, rich_accounts=parties[n_validators:], **chain_flags)
+        else:
+            color_print('Downloading testnet chainspec')
+            cmd = f'wget -O chainspec.json https://github.com/Cardinal-Cryptography/aleph-node/raw/main/bin/node/src/resources/testnet_chainspec.json'
+            print(run(cmd.split(), capture_output=True))
+
+    def node_keys(done):
+        parties = done['accounts']
+        bootstrap_nodes(parties[n_validators:] if chain != 'testnet' else parties, chain, **chain_flags)
+        generate_p2p_keys(parties)
+
+    def bundles(done):
+        color_print('building per-pid bundles')
+        pids = [pid for region_pids in done['ips'].values() for pid in region_pids.values()]
+        db_urls = None
+        if chain == 'testnet' and DB_SNAPSHOT_MODE == 'relay':
+            relays = db_relays(regions, tag)
+            db_urls = {pid: db_relay_url(relays[r].private_ip) for r, region_pids in done['ips'].items()
+                       for pid in region_pids.values()}
+        build_bundles(pids, chain, bundle_dispatch, db_urls=db_urls)
+
+    def open_22(done):
+        color_print('waiting till ports are open on machines')
+        return wait('open 22', regions, tag)
+
+    def fleet_task(task, pids=None):
+        color_print(task)
+        results = run_task(task, regions, parallel, tag, pids, journaled=True)
+        print_task_summary(results)
+        failed = [res.host for res in results if res.exit_status != 0]
+        if failed:
+            raise RuntimeError(f'task {task} failed on {len(failed)} hosts, run resume({tag!r}) to retry them')
+
+    def db_relay(done):
+        color_print('fetching testnet db backup to regional relays')
+        failed = [res.host for res in fetch_db_snapshot(regions, tag) if res.exit_status != 0]
+        if failed:
+            raise RuntimeError(f'fetching db backup failed on relays {failed}, run resume({tag!r}) to retry')
+
+    def extra(done):
+        for phase in extra_phases:
+            fleet_task(phase, done['ips'])
+
+    def pipeline(done):
+        phases = ['setup', 'send-data', 'run-nginx', *extra_phases]
+        color_print('running pipelined ' + ', '.join(phases))
+        results = run_pipeline(phases, regions, tag, done['ips'], journaled=True)
+        print_task_summary(results)
+        if any(res.exit_status != 0 for res in results):
+            raise RuntimeError(f'pipeline failed on some hosts, run resume({tag!r}) to retry them')
+
+    stages = [
+        Stage('launch', launch, []),
+        Stage('running', running, ['launch']),
+        Stage('ips', collect_ips, ['running']),
+        Stage('allow-traffic', lambda done: allow_all_traffic(regions, tag), ['launch']),
+        Stage('accounts', accounts, []),
+        Stage('chainspec', chainspec, ['accounts']),
+        Stage('node-keys', node_keys, ['chainspec']),
+        Stage('open-22', open_22, ['ips']),
+        Stage('bundles', bundles, ['ips', 'node-keys']),
+    ]
+    if pipelined:
+        stages.append(Stage('pipeline', pipeline, ['open-22', 'allow-traffic', 'chainspec', 'bundles']))
     else:
-        color_print('Downloading testnet chainspec')
-        cmd = f'wget -O chainspec.json https://github.com/Cardinal-Cryptography/aleph-node/raw/main/bin/node/src/resources/testnet_chainspec.json'
-        print(run(cmd.split(), capture_output=True))
-        bootstrap_nodes(parties, chain, **chain_flags)
-    generate_p2p_keys(parties)
-
-    color_print('waiting till ports are open on machines')
-    # wait('open 22', regions, tag)
-    sleep(45)
-
-    color_print('setup')
-    print(run_task('setup', regions, parallel, tag))
-
-    color_print('send data')
-    print(run_task('send-data', regions, parallel, tag, pids))
-
-    color_print('start nginx')
-    print(run_task('run-nginx', regions, parallel, tag))
+        stages += [
+            Stage('setup', lambda done: fleet_task('setup'), ['open-22', 'allow-traffic']),
+            Stage('send-data', lambda done: fleet_task('send-data', done['ips']), ['setup', 'chainspec', 'bundles']),
+            Stage('nginx', lambda done: fleet_task('run-nginx'), ['setup']),
+            Stage('extra-phases', extra, ['send-data', 'nginx']),
+        ]
+    if chain == 'testnet' and DB_SNAPSHOT_MODE == 'relay':
+        # relays need the packages installed by setup; nodes download the backup only once dispatched
+        stages.append(Stage('db-relay', db_relay, ['pipeline' if pipelined else 'setup']))
+
+    done = completed_stages(tag) if resume else {}
+    # bundles are cheap to build and live outside of the journal, so they are always built anew
+    done.pop('bundles', None)
+    # older journals list pids of a region by position only, they are assigned to ips anew
+    if any(isinstance(region_pids, list) for region_pids in done.get('ips', {}).values()):
+        done.pop('ips')
+    if done:
+        print('stages completed before:', *done)
+    results, timings = run_stages(stages, done=done, on_done=partial(stage_done, tag))
+    pids = results['ips']
 
     color_print(
         f'establishing the environment took {round(time() - start, 2)}s')
+    print_critical_path(timings)
 
     if terminate_in_min is not None:
         color_print('schedule termination')
         with open('bin/terminate', 'w') as f:
             f.write(f'{terminate_in_min}')
-        print(run_task('schedule-termination', regions, parallel, tag))
+        print_task_summary(run_task('schedule-termination', regions, parallel, tag, journaled=True))
 
     return pids
 
 
-def send_flooder_to_nodes(flooder_binary, regions=use_regions(), tag='dev'):
+@traced()
+def send_flooder_to_nodes(flooder_binary, regions=None, tag='dev'):
     os.makedirs('bin', exist_ok=True)
     shutil.copy(flooder_binary, 'bin/flooder')
 
@@ -539,35 +942,68 @@ def send_flooder_to_nodes(flooder_binary, regions=use_regions(), tag='dev'):
     run_task('send-flooder-binary', regions, True, tag)
 
 
-def setup_nodes(n_parties, chain='dev', regions=use_regions(), instance_type='t2.micro', volume_size=8, tag='dev',
+@traced_run
+def setup_nodes(n_parties, chain='dev', regions=None, instance_type='t2.micro', volume_size=8, tag='dev',
                 node_flags=None, benchmark_config=None, chain_flags=None, terminate_in_min=None, n_validators=None,
-                bootnodes=testnet_bootnodes()):
+                bootnodes=None, pipelined=False, resume=False):
     '''Setups the infrastructure and the binary. After it is successful, the 'dispatch'
-    task has to be run to start the nodes.'''
+    task has to be run to start the nodes. With pipelined set, every host goes through all setup
+    tasks on its own, see setup_infrastructure. If the run fails, resume(tag) continues it.'''
+
+    regions = use_regions() if regions is None else regions
+    bootnodes = testnet_bootnodes() if bootnodes is None else bootnodes
 
+    if not resume:
+        start_run(tag, 'setup_nodes', dict(
+            n_parties=n_parties, chain=chain, regions=regions, instance_type=instance_type, volume_size=volume_size,
+            tag=tag, node_flags=node_flags, benchmark_config=benchmark_config, chain_flags=chain_flags,
+            terminate_in_min=terminate_in_min, n_validators=n_validators, bootnodes=bootnodes, pipelined=pipelined))
+
+    # dispatch scripts are part of the bundles sent by send-data, they are built from these files
+    save_node_flags(node_flags or dict())
+    if chain == 'testnet':
+        write_bootnodes(bootnodes)
+
+    if pipelined:
+        return setup_infrastructure(
+            n_parties, chain, regions, instance_type, volume_size, tag, benchmark_config, terminate_in_min, n_validators,
+            pipelined=True, extra_phases=['send-binary', 'send-cli-binary', 'install-prometheus-exporter'],
+            resume=True, bundle_dispatch=True, **(chain_flags or dict()))
+
+    # the run was started above, so setup_infrastructure only continues its journal
     pids = setup_infrastructure(
-        n_parties, chain, regions, instance_type, volume_size, tag, benchmark_config, terminate_in_min, n_validators, **(chain_flags or dict()))
+        n_parties, chain, regions, instance_type, volume_size, tag, benchmark_config, terminate_in_min, n_validators,
+        resume=True, bundle_dispatch=True, **(chain_flags or dict()))
 
     parallel = n_parties > 1
 
     color_print('send the binary')
-    run_task('send-binary', regions, parallel, tag)
+    run_task('send-binary', regions, parallel, tag, journaled=True)
 
     color_print('send the CLI binary')
-    run_task('send-cli-binary', regions, parallel, tag)
-
-    save_node_flags(node_flags or dict())
-    if chain == 'testnet':
-        write_bootnodes(bootnodes)
-        run_task('create-testnet-dispatch-cmd', regions, parallel, tag, pids)
-    else:
-        run_task('create-dispatch-cmd', regions, parallel, tag, pids)
+    run_task('send-cli-binary', regions, parallel, tag, journaled=True)
 
-    run_task('install-prometheus-exporter', regions, parallel, tag)
+    run_task('install-prometheus-exporter', regions, parallel, tag, journaled=True)
 
     return pids
 
 
+def resume(tag='dev'):
+    '''
+    Continues the last setup_nodes or setup_infrastructure run of a given tag with the same parameters.
+    Stages completed before are skipped and tasks run only on hosts that did not complete them.
+    '''
+
+    run = journal_of(tag)['run']
+    if run is None:
+        print(f'there is no run of tag {tag} to resume')
+        return
+
+    color_print(f"resuming {run['routine']} of tag {tag}")
+    return globals()[run['routine']](**run['params'], resume=True)
+
+
+@traced()
 def change_validators(regions, tag, pids):
     color_print('collecting validator accounts')
     with open("new_validators", "w") as f:
@@ -579,14 +1015,15 @@ def change_validators(regions, tag, pids):
                 output, error = process.communicate()
                 f.write(output.decode('utf-8'))
     color_print('rotating keys')
-    print(run_task('rotate-keys', regions, True, tag, pids))
+    print_task_summary(run_task('rotate-keys', regions, True, tag, pids))
     color_print('changing validators')
     first_region = regions[0]
     pids = {first_region: pids[first_region][:1]}
-    print(run_task('rotate-validators', regions[:1], True, tag, pids))
+    print_task_summary(run_task('rotate-validators', regions[:1], True, tag, pids))
 
 
-def prepare_benchmark_script(benchmark_config, n_parties, regions=use_regions(), tag='dev'):
+@traced()
+def prepare_benchmark_script(benchmark_config, n_parties, regions=None, tag='dev'):
     n_of_accounts = int(benchmark_config.get('n_of_accounts', 1000))
     flooder_binary = benchmark_config.get('flooder_binary', 'flooder')
     transactions = int(benchmark_config.get('transactions', 1000))
@@ -615,9 +1052,10 @@ def prepare_benchmark_script(benchmark_config, n_parties, regions=use_regions(),
     send_flooder_to_nodes(flooder_binary, regions, tag)
 
 
-def setup_benchmark(n_parties, chain='dev', regions=use_regions(), instance_type='t2.micro', volume_size=8, tag='dev',
+@traced_run
+def setup_benchmark(n_parties, chain='dev', regions=None, instance_type='t2.micro', volume_size=8, tag='dev',
                     node_flags=None, benchmark_config=None, chain_flags=None, terminate_in_min=60, n_validators=None,
-                    bootnodes=testnet_bootnodes()):
+                    bootnodes=None):
     '''Setups the infrastructure and the binary. After it is successful, the 'dispatch'
     task has to be run to start the benchmark.'''
 
@@ -632,7 +1070,10 @@ def setup_benchmark(n_parties, chain='dev', regions=use_regions(), instance_type
     return pids
 
 
-def setup_flooding(region=default_region(), tag='flooders'):
+@traced_run
+def setup_flooding(region=None, tag='flooders'):
+    region = region or default_region()
+
     color_print('launching instance')
     launch_new_instances_in_region(n_parties=1, region_name=region, tag=tag)
 
@@ -649,7 +1090,8 @@ def setup_flooding(region=default_region(), tag='flooders'):
     run_task('start-flooding', regions=[region], parallel=False, tag=tag)
 
 
-def run_devnet(n_parties, regions=use_regions(), instance_type='t2.micro'):
+@traced_run
+def run_devnet(n_parties, regions=None, instance_type='t2.micro'):
     pids = setup_infrastructure(n_parties, regions, instance_type)
 
     parallel = n_parties > 1
@@ -666,7 +1108,11 @@ def run_devnet(n_parties, regions=use_regions(), instance_type='t2.micro'):
     instances_state(testnet_regions(), 'testnet')
 
 
-def setup_prometheus(region=default_region(), tag='prometheus', target_regions=use_regions(), target_tag="dev"):
+@traced_run
+def setup_prometheus(region=None, tag='prometheus', target_regions=None, target_tag="dev"):
+    region = region or default_region()
+    target_regions = use_regions() if target_regions is None else target_regions
+
     color_print('retrieving target ips')
     ips = [ip for region in target_regions for ip in instances_ip_in_region(
         region_name=region, tag=target_tag)]
@@ -684,6 +1130,7 @@ def setup_prometheus(region=default_region(), tag='prometheus', target_regions=u
     run_task('setup', regions=[region], parallel=False, tag=tag)
 
     color_print('creating prometheus.yml configuration file')
+    import yaml
     config = create_prometheus_configuration(ips)
     with open('prometheus.yml', 'w') as yml_file:
         yaml.dump(config, yml_file)
@@ -696,20 +1143,23 @@ def setup_prometheus(region=default_region(), tag='prometheus', target_regions=u
     run_task('install-prometheus', regions=[region], parallel=False, tag=tag)
 
 
-def setup_smart_flooder(path_to_contract_repo, region=default_region(), tag='dev', pids=None):
+def setup_smart_flooder(path_to_contract_repo, region=None, tag='dev', pids=None):
+    region = region or default_region()
+
     shutil.copytree(path_to_contract_repo, './bin/contracts-cli',
                     ignore=shutil.ignore_patterns('.git', 'node_modules', 'target'), dirs_exist_ok=True)
 
     call('yarn'.split(), cwd='./bin/contracts-cli/deploy')
     call('yarn redspot compile'.split(), cwd='./bin/contracts-cli/deploy')
     call('cargo clean'.split(), cwd='./bin/contracts-cli/deploy')
-    call('zip -r ./repo.zip ./contracts-cli'.split(),  cwd='./bin')
 
     color_print('setup ...')
     run_task('setup-contract-repo', regions=[region], tag=tag, pids=pids)
 
 
-def start_smart_flooder(signer='//Alice', methods_to_call=None, n_of_calls=None, region=default_region(), tag='dev', pids=None):
+def start_smart_flooder(signer='//Alice', methods_to_call=None, n_of_calls=None, region=None, tag='dev', pids=None):
+    region = region or default_region()
+
     script = f"""
 #!/usr/bin/env bash
 cd contracts-cli
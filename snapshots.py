@@ -0,0 +1,316 @@
+'''Chain snapshots taken from a running fleet, used to let new or restarted nodes skip syncing from genesis.
+
+A snapshot is a consistent copy of the database of one node (data/{auth}/chains/{chain}/db). The
+node is stopped only while its database is copied on its own disk: immutable .sst files are
+hardlinked and the rest is copied, then the node is restarted and the copy is fetched from there.
+Files are kept under SNAPSHOTS_DIR compressed and named by the sha256 of their contents, and a
+manifest lists them per snapshot, so a subsequent snapshot fetches only files that changed and
+seeding a node sends only files it does not have yet.
+'''
+
+import json
+import os
+import shlex
+import tempfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+from subprocess import PIPE, Popen, run
+from time import strftime, time
+
+from artifacts import sha256_of
+from concurrency import limiter
+from dispatch import connection
+from tracing import record
+from transfer import get_tree, send_stream
+from utils import file_lock, read_json, write_json_atomic
+
+SNAPSHOTS_DIR = 'snapshots'
+SNAPSHOT_OBJECTS = os.path.join(SNAPSHOTS_DIR, 'objects')
+# zstd level; every file is compressed once, when it is seen for the first time
+SNAPSHOT_COMPRESSION = 6
+# number of manifests kept per chain, files referenced only by older ones are removed
+SNAPSHOTS_KEEP = 3
+# directory next to the node's base path the database is copied to while the node is stopped
+SNAPSHOT_STAGE = 'snapshot_stage'
+# seconds a node gets to shut down cleanly before it is killed
+NODE_STOP_TIMEOUT = 60
+SNAPSHOT_WORKERS = 16
+
+# suffix of compressed files in the stream sent to a host and the file listing files to remove there
+_PACKED = '.snapshot.zst'
+_REMOVED = '.snapshot_removed'
+
+# one node seeded from a snapshot: files sent and removed, compressed bytes sent
+SeedResult = namedtuple('SeedResult', ['host', 'sent', 'removed', 'bytes', 'start', 'end', 'error'])
+
+
+def chain_id(chainspec='chainspec.json'):
+    ''' Returns the id of the chain of a given chainspec, the name of its directory in base paths of nodes.'''
+
+    with open(chainspec, 'r') as f:
+        return json.load(f)['id']
+
+
+def db_dir(auth, chain):
+    return f'data/{auth}/chains/{chain}/db'
+
+
+def object_path(sha256):
+    return os.path.join(SNAPSHOT_OBJECTS, sha256 + '.zst')
+
+
+def _manifests_dir(chain):
+    return os.path.join(SNAPSHOTS_DIR, chain)
+
+
+def snapshot_names(chain):
+    ''' Returns names of snapshots of a given chain, the oldest first.'''
+
+    if not os.path.isdir(_manifests_dir(chain)):
+        return []
+
+    return sorted(name[:-len('.json')] for name in os.listdir(_manifests_dir(chain)) if name.endswith('.json'))
+
+
+def load_manifest(chain, name=None):
+    '''
+    Returns the manifest of a snapshot: dict with the chain, the source host, the time it was taken and
+    files, a dict path --> {'sha256', 'size', 'mtime'} of paths relative to the database directory.
+    :param string name: name of the snapshot, the newest one by default
+    '''
+
+    names = snapshot_names(chain)
+    name = name or (names[-1] if names else None)
+    manifest = read_json(os.path.join(_manifests_dir(chain), f'{name}.json')) if name else None
+    if manifest is None:
+        raise ValueError(f'there is no snapshot {name or ""} of chain {chain}')
+
+    return manifest
+
+
+def _stop_node(conn):
+    ''' Stops the node running on a host, returns True if it was running.'''
+
+    if conn.run('pgrep -x aleph-node', hide='both', warn=True).failed:
+        return False
+    stopped = conn.run(f'killall aleph-node; timeout {NODE_STOP_TIMEOUT} sh -c '
+                       f'"while pgrep -x aleph-node > /dev/null; do sleep 1; done"', hide='both', warn=True)
+    if stopped.failed:
+        conn.run('killall -9 aleph-node', hide='both', warn=True)
+
+    return True
+
+
+def _start_node(conn):
+    conn.run('dtach -n `mktemp -u /tmp/dtach.XXXX` sh /home/ubuntu/cmd.sh', hide='both')
+
+
+def _remote_files(conn, directory):
+    ''' Returns dict path --> (size, mtime) of files under a directory on a host, paths relative to the directory.'''
+
+    res = conn.run(f'test ! -d {directory} || (cd {directory} && find . -type f -printf "%s %T@ %P\\n")', hide='both')
+    files = {}
+    for line in res.stdout.splitlines():
+        size, mtime, path = line.split(' ', 2)
+        files[path] = (int(size), mtime)
+
+    return files
+
+
+def _remote_sha256(conn, directory, paths):
+    ''' Returns dict path --> sha256 of given files under a directory on a host.'''
+
+    if not paths:
+        return {}
+    # the listing is kept next to the directory, the command reads it from within the directory
+    listing = f'../{SNAPSHOT_STAGE}.paths'
+    send_stream(conn, BytesIO('\n'.join(paths).encode()), f'cat > {directory}/{listing}')
+    res = conn.run(f'cd {directory} && xargs -d "\\n" -r sha256sum < {listing} && rm -f {listing}', hide='both')
+    shas = {}
+    for line in res.stdout.splitlines():
+        sha, path = line.split('  ', 1)
+        shas[path] = sha
+
+    return shas
+
+
+def _store(path, sha256):
+    ''' Verifies a fetched file and compresses it into the object store unless it is there already.'''
+
+    if sha256_of(path) != sha256:
+        raise RuntimeError(f'{path} changed while it was fetched')
+    if not os.path.exists(object_path(sha256)):
+        run(['zstd', '-q', '-f', f'-{SNAPSHOT_COMPRESSION}', path, '-o', object_path(sha256) + '.tmp'], check=True)
+        os.replace(object_path(sha256) + '.tmp', object_path(sha256))
+
+
+def take_snapshot(host, auth, chain=None, restart=True):
+    '''
+    Takes a snapshot of the database of the node of a given validator. The node is stopped only for
+    the time of copying its database on its own disk. Only files not present in the store yet are fetched.
+    :param string host: public ip of the host of the node
+    :param string chain: id of the chain, read from the local chainspec by default
+    :param bool restart: indicates whether the node should be started again if it was running
+    :returns: name of the snapshot
+    '''
+
+    chain = chain or chain_id()
+    conn = connection(host)
+    stage = f'{os.path.dirname(db_dir(auth, chain))}/{SNAPSHOT_STAGE}'
+    # files other than .sst are modified in place, so they are copied instead of linked
+    unlink = shlex.quote('cp -p "$1" "$1.tmp" && mv "$1.tmp" "$1"')
+
+    start = time()
+    running = _stop_node(conn)
+    try:
+        conn.run(f'rm -rf {stage} && mkdir -p {stage} && cp -al {db_dir(auth, chain)}/. {stage}/ && '
+                 f'find {stage} -type f ! -name "*.sst" -exec sh -c {unlink} _ {{}} \\;', hide='both')
+    finally:
+        if running and restart:
+            _start_node(conn)
+    record('node stopped', start, time(), 'snapshot', track=host)
+
+    try:
+        files = _remote_files(conn, stage)
+        previous = {}
+        names = snapshot_names(chain)
+        if names:
+            manifest = load_manifest(chain, names[-1])
+            if manifest['source'] == host:
+                previous = manifest['files']
+        # files of the previous snapshot of the same node with the same size and mtime are not hashed again
+        shas = {path: previous[path]['sha256'] for path, (size, mtime) in files.items()
+                if path in previous and (previous[path]['size'], previous[path]['mtime']) == (size, mtime)}
+        shas.update(_remote_sha256(conn, stage, [path for path in files if path not in shas]))
+
+        new = {}
+        for path, sha in shas.items():
+            if not os.path.exists(object_path(sha)):
+                new.setdefault(sha, path)
+        os.makedirs(SNAPSHOT_OBJECTS, exist_ok=True)
+        fetched = 0
+        if new:
+            with tempfile.TemporaryDirectory(dir=SNAPSHOTS_DIR) as tmp:
+                fetch_start = time()
+                fetched = get_tree(conn, sorted(new.values()), local_dir=tmp, remote_dir=stage)
+                record('fetch', fetch_start, time(), 'snapshot', track=host, files=len(new), bytes=fetched)
+                with ThreadPoolExecutor(max_workers=SNAPSHOT_WORKERS) as pool:
+                    list(pool.map(lambda item: _store(os.path.join(tmp, item[1]), item[0]), new.items()))
+    finally:
+        conn.run(f'rm -rf {stage}', hide='both', warn=True)
+
+    name = strftime('%Y%m%d-%H%M%S')
+    os.makedirs(_manifests_dir(chain), exist_ok=True)
+    write_json_atomic(os.path.join(_manifests_dir(chain), f'{name}.json'), {
+        'chain': chain, 'source': host, 'time': start,
+        'files': {path: {'sha256': shas[path], 'size': size, 'mtime': mtime} for path, (size, mtime) in files.items()},
+    })
+    total = sum(size for size, _ in files.values())
+    print(f'snapshot {chain}/{name}: {len(files)} files, {total / 1e6:.1f} MB, '
+          f'fetched {len(new)} new files ({fetched / 1e6:.1f} MB) in {time() - start:.1f}s')
+    prune_snapshots(chain)
+
+    return name
+
+
+def prune_snapshots(chain, keep=SNAPSHOTS_KEEP):
+    ''' Drops all but keep newest snapshots of a given chain and files not referenced by any snapshot left.'''
+
+    with file_lock(os.path.join(SNAPSHOTS_DIR, 'prune')):
+        for name in snapshot_names(chain)[:-keep]:
+            os.remove(os.path.join(_manifests_dir(chain), f'{name}.json'))
+
+        referenced = set()
+        for manifests_chain in os.listdir(SNAPSHOTS_DIR):
+            if os.path.isdir(_manifests_dir(manifests_chain)) and manifests_chain != 'objects':
+                for name in snapshot_names(manifests_chain):
+                    files = load_manifest(manifests_chain, name)['files']
+                    referenced.update(entry['sha256'] for entry in files.values())
+        for obj in os.listdir(SNAPSHOT_OBJECTS):
+            if obj.endswith('.zst') and obj[:-len('.zst')] not in referenced:
+                os.remove(os.path.join(SNAPSHOT_OBJECTS, obj))
+
+
+def _unpack_cmd(directory):
+    ''' Remote command unpacking a stream of compressed files into a database directory and removing stale files.'''
+
+    return (f'mkdir -p {directory} && cd {directory} && tar -xf - '
+            f'&& xargs -0 -r rm -f < {_REMOVED} && rm -f {_REMOVED} '
+            f'&& find . -name "*{_PACKED}" -print0 | while IFS= read -r -d "" f; '
+            f'do zstd -q -d --rm -f "$f" -o "${{f%{_PACKED}}}" < /dev/null || exit 1; done')
+
+
+def seed_snapshot(host, auth, manifest, restart=True):
+    '''
+    Makes the database of the node of a given validator equal to a snapshot. Files the node already
+    has are kept, only missing and changed ones are sent, files not in the snapshot are removed.
+    The node is stopped for that time.
+    :param dict manifest: manifest of the snapshot, see load_manifest
+    :param bool restart: indicates whether the node should be started again if it was running
+    :returns: SeedResult
+    '''
+
+    conn = connection(host)
+    directory = db_dir(auth, manifest['chain'])
+    files = manifest['files']
+
+    start = time()
+    sent, removed, size, error = [], [], 0, None
+    running = False
+    try:
+        running = _stop_node(conn)
+        remote = _remote_files(conn, directory)
+        # files of different sizes differ anyway, only the rest is worth hashing
+        shas = _remote_sha256(conn, directory, [path for path, (rsize, _) in remote.items()
+                                                if path in files and files[path]['size'] == rsize])
+        sent = [path for path, entry in files.items() if shas.get(path) != entry['sha256']]
+        removed = [path for path in remote if path not in files]
+
+        if sent or removed:
+            with tempfile.TemporaryDirectory(dir=SNAPSHOTS_DIR) as tmp:
+                for path in sent:
+                    os.makedirs(os.path.dirname(os.path.join(tmp, path)), exist_ok=True)
+                    os.symlink(os.path.abspath(object_path(files[path]['sha256'])), os.path.join(tmp, path + _PACKED))
+                with open(os.path.join(tmp, _REMOVED), 'w') as f:
+                    f.write(''.join(path + '\0' for path in removed))
+                proc = Popen(['tar', '-C', tmp, '-chf', '-', '.'], stdout=PIPE)
+                try:
+                    with limiter('upload').slot('seed-snapshot', host):
+                        size = send_stream(conn, proc.stdout, _unpack_cmd(directory))
+                finally:
+                    proc.stdout.close()
+                if proc.wait() != 0:
+                    raise RuntimeError(f'packing the snapshot failed with {proc.returncode}')
+    except Exception as e:
+        error = f'{type(e).__name__}: {e}'
+    finally:
+        if running and restart:
+            _start_node(conn)
+
+    result = SeedResult(host, len(sent), len(removed), size, start, time(), error)
+    record('seed', result.start, result.end, 'snapshot', track=host, files=result.sent, bytes=size,
+           ok=error is None)
+
+    return result
+
+
+def seed_snapshot_to_hosts(hosts, auths, chain=None, name=None, restart=True, max_workers=SNAPSHOT_WORKERS):
+    '''
+    Seeds nodes on given hosts from a snapshot, many of them at once.
+    :param list hosts: public ips of hosts
+    :param list auths: validator accounts of nodes on the hosts, in the same order
+    :param string name: name of the snapshot, the newest one by default
+    :returns: list of SeedResult in the order of hosts
+    '''
+
+    manifest = load_manifest(chain or chain_id(), name)
+    with ThreadPoolExecutor(max_workers=max(1, min(len(hosts), max_workers))) as pool:
+        return list(pool.map(lambda args: seed_snapshot(*args, manifest, restart), zip(hosts, auths)))
+
+
+def print_seed_results(results):
+    for res in results:
+        status = 'ok' if res.error is None else res.error
+        print(f'{res.host:16} sent {res.sent:6} files {res.bytes / 1e6:10.1f} MB  removed {res.removed:6}'
+              f'  took {res.end - res.start:8.2f}s  {status}')
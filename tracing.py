@@ -0,0 +1,188 @@
+'''Span instrumentation of orchestration runs.
+
+Every finished span is appended as one json line to TRACE_LOG, so spans recorded in joblib workers
+end up in the same log. export_trace turns the log into a Chrome trace file, which can be opened
+in chrome://tracing or https://ui.perfetto.dev.
+'''
+
+import inspect
+import json
+import os
+from functools import wraps
+from itertools import count
+from threading import Lock, current_thread
+from time import time
+
+TRACE_LOG = 'trace.jsonl'
+TRACE_FILE = 'trace.json'
+TRACE_ENABLED = True
+
+_tracks = {}
+_tracks_lock = Lock()
+_track_ids = count(1)
+_runs_depth = 0
+
+
+def _append(event):
+    line = (json.dumps(event) + '\n').encode()
+    # a single write to a file opened with O_APPEND is not interleaved with writes of other processes
+    fd = os.open(TRACE_LOG, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def _track(label):
+    ''' Returns the id of a track (a row in the trace viewer) with a given label.'''
+
+    with _tracks_lock:
+        tid = _tracks.get(label)
+        if tid is None:
+            tid = _tracks[label] = next(_track_ids)
+
+    return tid
+
+
+def record(name, start, end, cat='shell', track=None, **args):
+    '''
+    Records a finished span.
+    :param float start: start of the span, seconds since epoch
+    :param float end: end of the span, seconds since epoch
+    :param string track: label of the row the span is shown in, the current thread by default
+    '''
+
+    if not TRACE_ENABLED or start is None or end is None:
+        return
+
+    _append({
+        'name': name,
+        'cat': cat,
+        'ph': 'X',
+        'ts': round(start * 1e6),
+        'dur': round((end - start) * 1e6),
+        'pid': os.getpid(),
+        'tid': _track(track or current_thread().name),
+        'track': track or current_thread().name,
+        'args': {key: str(value) for key, value in args.items()},
+    })
+
+
+def counter(name, value, cat='shell'):
+    ''' Records the value of a counter, shown in the trace viewer as a graph over time.'''
+
+    if not TRACE_ENABLED:
+        return
+
+    _append({'name': name, 'cat': cat, 'ph': 'C', 'ts': round(time() * 1e6), 'pid': os.getpid(),
+             'args': {'value': value}})
+
+
+def mark(name, cat='shell', track=None, **args):
+    ''' Records an instant event, e.g. a decision taken during the run.'''
+
+    if not TRACE_ENABLED:
+        return
+
+    _append({
+        'name': name,
+        'cat': cat,
+        'ph': 'i',
+        's': 't',
+        'ts': round(time() * 1e6),
+        'pid': os.getpid(),
+        'tid': _track(track or current_thread().name),
+        'track': track or current_thread().name,
+        'args': {key: str(value) for key, value in args.items()},
+    })
+
+
+class span:
+    ''' Context manager recording the time spent inside it.'''
+
+    def __init__(self, name, cat='shell', track=None, **args):
+        self.name, self.cat, self.track, self.args = name, cat, track, args
+
+    def __enter__(self):
+        self.start = time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.args['error'] = f'{exc_type.__name__}: {exc}'
+        record(self.name, self.start, time(), self.cat, self.track, **self.args)
+
+
+def traced(cat='shell'):
+    ''' Decorator recording a span for every call of a function, labeled with its region, tag and task.'''
+
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            if not TRACE_ENABLED:
+                return func(*args, **kwargs)
+            bound = signature.bind_partial(*args, **kwargs).arguments
+            attrs = {key: bound[key] for key in ('region_name', 'tag', 'task') if key in bound}
+            with span(func.__name__, cat, **attrs):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def traced_run(func):
+    '''
+    Decorator for top-level orchestration routines (e.g. setup_nodes). The outermost call starts
+    a fresh trace and exports it to TRACE_FILE when it returns, nested calls just record spans.
+    '''
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        global _runs_depth
+
+        if not TRACE_ENABLED:
+            return func(*args, **kwargs)
+
+        if _runs_depth == 0:
+            start_trace()
+        _runs_depth += 1
+        try:
+            with span(func.__name__, 'run'):
+                return func(*args, **kwargs)
+        finally:
+            _runs_depth -= 1
+            if _runs_depth == 0:
+                print('trace of the run written to', export_trace())
+
+    return wrapper
+
+
+def start_trace():
+    ''' Drops spans recorded so far.'''
+
+    if os.path.exists(TRACE_LOG):
+        os.remove(TRACE_LOG)
+    with _tracks_lock:
+        _tracks.clear()
+
+
+def export_trace(path=TRACE_FILE):
+    ''' Writes spans recorded so far to a Chrome trace file.'''
+
+    events = []
+    if os.path.exists(TRACE_LOG):
+        with open(TRACE_LOG, 'r') as f:
+            events = [json.loads(line) for line in f if line.strip()]
+
+    # name the rows after labels of tracks
+    tracks = {(e['pid'], e['tid']): e.pop('track') for e in events if 'track' in e}
+    events += [{'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid, 'args': {'name': label}}
+               for (pid, tid), label in tracks.items()]
+
+    with open(path, 'w') as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+
+    return path
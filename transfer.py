@@ -0,0 +1,108 @@
+'''Streaming transfers of files between this machine and hosts.
+
+Files are packed with tar, compressed with zstd and unpacked on the other side while they are
+being read, all over a single ssh channel, so there are no temporary archives on either side.
+Requires tar and zstd locally and on hosts.
+'''
+
+import shlex
+from subprocess import Popen, PIPE
+
+TRANSFER_COMPRESSION = 3
+CHUNK_SIZE = 1 << 20
+
+
+def _exec(conn, cmd):
+    ''' Opens a new channel of the ssh transport of a connection and starts a command in it.'''
+
+    if not conn.is_connected:
+        conn.open()
+    chan = conn.client.get_transport().open_session()
+    # a failure in any part of a pipeline fails the whole command
+    chan.exec_command(f'set -o pipefail; {cmd}')
+
+    return chan
+
+
+def _check(chan, cmd, proc=None):
+    ''' Waits for the remote command (and the local process) to finish, raises if any of them failed.'''
+
+    status = chan.recv_exit_status()
+    err = b''
+    while chan.recv_stderr_ready():
+        err += chan.recv_stderr(CHUNK_SIZE)
+    chan.close()
+    if status != 0:
+        raise RuntimeError(f'remote command {cmd} exited with {status}: {err.decode(errors="replace").strip()}')
+    if proc is not None and proc.wait() != 0:
+        raise RuntimeError(f'local part of the transfer exited with {proc.returncode}')
+
+
+def send_stream(conn, source, remote_cmd):
+    '''
+    Writes everything read from a binary file-like source to stdin of a remote command.
+    :returns: number of bytes sent
+    '''
+
+    chan = _exec(conn, remote_cmd)
+    sent = 0
+    try:
+        for chunk in iter(lambda: source.read(CHUNK_SIZE), b''):
+            chan.sendall(chunk)
+            sent += len(chunk)
+        chan.shutdown_write()
+    finally:
+        _check(chan, remote_cmd)
+
+    return sent
+
+
+def send_tree(conn, paths, remote_dir='.', local_dir='.', level=None):
+    '''
+    Sends files and directories to a host as a tar+zstd stream unpacked on the fly.
+    :param list paths: paths relative to local_dir, they keep their relative paths under remote_dir
+    :param int level: zstd compression level, TRANSFER_COMPRESSION by default
+    :returns: number of compressed bytes sent
+    '''
+
+    level = TRANSFER_COMPRESSION if level is None else level
+    pack = (f'tar -C {shlex.quote(local_dir)} -cf - {" ".join(map(shlex.quote, paths))}'
+            f' | zstd -q -{level} -T0 -c')
+    unpack = f'mkdir -p {shlex.quote(remote_dir)} && zstd -q -dc | tar -xf - -C {shlex.quote(remote_dir)}'
+
+    proc = Popen(['bash', '-o', 'pipefail', '-c', pack], stdout=PIPE)
+    try:
+        sent = send_stream(conn, proc.stdout, unpack)
+    finally:
+        proc.stdout.close()
+    if proc.wait() != 0:
+        raise RuntimeError(f'packing {paths} failed with {proc.returncode}')
+
+    return sent
+
+
+def get_tree(conn, paths, local_dir='.', remote_dir='.', level=None):
+    '''
+    Fetches files and directories from a host as a tar+zstd stream unpacked on the fly.
+    :param list paths: paths relative to remote_dir, they keep their relative paths under local_dir
+    :param int level: zstd compression level, TRANSFER_COMPRESSION by default
+    :returns: number of compressed bytes received
+    '''
+
+    level = TRANSFER_COMPRESSION if level is None else level
+    pack = (f'tar -C {shlex.quote(remote_dir)} -cf - {" ".join(map(shlex.quote, paths))}'
+            f' | zstd -q -{level} -T0 -c')
+    unpack = f'mkdir -p {shlex.quote(local_dir)} && zstd -q -dc | tar -xf - -C {shlex.quote(local_dir)}'
+
+    proc = Popen(['bash', '-o', 'pipefail', '-c', unpack], stdin=PIPE)
+    chan = _exec(conn, pack)
+    received = 0
+    try:
+        for chunk in iter(lambda: chan.recv(CHUNK_SIZE), b''):
+            proc.stdin.write(chunk)
+            received += len(chunk)
+    finally:
+        proc.stdin.close()
+        _check(chan, pack, proc)
+
+    return received
@@ -1,33 +1,199 @@
 '''Helper functions for shell'''
 
+import fcntl
+import hashlib
 import json
 import os
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from typing import List
 from pathlib import Path
 from subprocess import run
-from bip_utils import SubstrateBip39SeedGenerator, SubstrateCoins, Substrate
-import boto3
+from time import sleep, time
+from threading import Lock, local
+
+from concurrency import THROTTLING_CODES, is_throttling, limiter
+from tracing import record, traced
+
+
+InstanceRecord = namedtuple(
+    'InstanceRecord', ['id', 'region', 'public_ip', 'private_ip', 'state', 'az'])
+
+# size of the http connection pool kept open by every pooled client
+AWS_MAX_POOL_CONNECTIONS = 50
+
+# security groups allowing traffic from more ips reference a managed prefix list instead;
+# aws counts max entries of a referenced list against the rules quota of the group (60 by default),
+# so the list is sized to exactly the number of ips
+PREFIX_LIST_THRESHOLD = 20
+# inbound rules a security group may hold, references to prefix lists count with their max entries
+SECURITY_GROUP_RULES_QUOTA = 60
+
+# accounts are generated in a pool of processes in batches of this size, fewer are generated in this process
+ACCOUNT_BATCH = 64
+ACCOUNT_JOBS = -1
+
+# phrase benchmark accounts //0, //1, ... are derived from
+BENCHMARK_PHRASE = 'bottom drive obey lake curtain smoke basket hold race lonely fit walk'
+# public keys of derived accounts, 32 bytes per account, in one file per phrase
+DERIVATION_CACHE_DIR = '.derivation_cache'
+# number of consecutive accounts derived by one task of the process pool
+DERIVATION_SHARD = 8192
+# number of shards derived by the pool before they are written to the cache
+DERIVATION_ROUND = 4 * (os.cpu_count() or 4)
+# ss58 format of account ids, the generic substrate one
+SS58_FORMAT = 42
+# number of aleph-node processes bootstrapping accounts at once
+BOOTSTRAP_WORKERS = os.cpu_count() or 4
+
+_aws_lock = Lock()
+_aws_session = None
+_aws_clients = {}
+_aws_resources = local()
+_aws_generation = 0
+
+
+# ======================================================================================
+#                              pooled aws sessions and clients
+# ======================================================================================
+
+
+def aws_session():
+    ''' Returns the boto3 session shared by the whole process.'''
+
+    global _aws_session
+
+    with _aws_lock:
+        if _aws_session is None:
+            import boto3
+            _aws_session = boto3.session.Session()
+        return _aws_session
+
+
+def _limit_api_calls(client):
+    '''
+    Makes every ec2 api call of a given client take a slot of the 'ec2' concurrency limit. Calls that
+    aws throttled (even if botocore retried them successfully) make the limit back off.
+    '''
+
+    if client.meta.service_model.service_name != 'ec2':
+        return client
+
+    limit = limiter('ec2')
+    region_name = client.meta.region_name
+
+    def before_call(context, **kwargs):
+        context['limit_start'] = limit.acquire()
+
+    def after_call(http_response, parsed, model, context, **kwargs):
+        if 'limit_start' in context:
+            retries = parsed.get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            throttled = retries > 0 or parsed.get('Error', {}).get('Code') in THROTTLING_CODES
+            limit.release(model.name, context.pop('limit_start'), http_response.status_code < 500, throttled,
+                          region_name)
+
+    def after_call_error(exception, context, **kwargs):
+        if 'limit_start' in context:
+            limit.release('connection', context.pop('limit_start'), False, is_throttling(exception), region_name)
+
+    client.meta.events.register('before-call.ec2', before_call)
+    client.meta.events.register('after-call.ec2', after_call)
+    client.meta.events.register('after-call-error.ec2', after_call_error)
+
+    return client
+
+
+def aws_client(service, region_name):
+    '''
+    Returns a client for a given service and region. Clients are thread-safe, hence one client
+    (and its pool of keep-alive connections) is shared by all threads of the process.
+    '''
+
+    key = (service, region_name)
+    client = _aws_clients.get(key)
+    if client is None:
+        from botocore.config import Config
+        session = aws_session()
+        # creating clients from one session is not thread-safe
+        with _aws_lock:
+            if key not in _aws_clients:
+                _aws_clients[key] = _limit_api_calls(session.client(
+                    service, region_name,
+                    config=Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS)))
+            client = _aws_clients[key]
+
+    return client
+
+
+def aws_resource(service, region_name):
+    '''
+    Returns a resource for a given service and region. Resources are not thread-safe, hence
+    every thread keeps its own one per region.
+    '''
+
+    if getattr(_aws_resources, 'generation', None) != _aws_generation:
+        _aws_resources.pool, _aws_resources.generation = {}, _aws_generation
+    resources = _aws_resources.pool
+    key = (service, region_name)
+    if key not in resources:
+        from botocore.config import Config
+        session = aws_session()
+        with _aws_lock:
+            resources[key] = session.resource(
+                service, region_name,
+                config=Config(max_pool_connections=AWS_MAX_POOL_CONNECTIONS))
+        _limit_api_calls(resources[key].meta.client)
+
+    return resources[key]
+
+
+def ec2_client(region_name):
+    return aws_client('ec2', region_name)
+
+
+def ec2_resource(region_name):
+    return aws_resource('ec2', region_name)
+
+
+def reset_aws_pool(max_pool_connections=None):
+    '''
+    Drops all pooled clients, e.g. after changing credentials. Optionally changes the size of
+    connection pools of clients created from now on.
+    '''
+
+    global _aws_session, _aws_generation, AWS_MAX_POOL_CONNECTIONS
+
+    with _aws_lock:
+        if max_pool_connections is not None:
+            AWS_MAX_POOL_CONNECTIONS = max_pool_connections
+        _aws_session = None
+        _aws_clients.clear()
+        # resources of all threads are dropped lazily on their next use
+        _aws_generation += 1
 
 
 def azero():
     return int(1e12)
 
+@traced('ec2')
 def image_id_in_region(region_name, image_name='testnet1'):
     '''Find id of os image we use. The id may differ for different regions'''
 
     if image_name == 'ubuntu':
         image_name = 'ubuntu/images/hvm-ssd/ubuntu-focal-20.04-amd64-server-20230502'
 
-    ec2 = boto3.resource('ec2', region_name)
+    ec2 = ec2_resource(region_name)
     # in the below, there is only one image in the iterator
     for image in ec2.images.filter(Filters=[{'Name': 'name', 'Values': [image_name]}]):
         return image.id
 
 
+@traced('ec2')
 def vpc_id_in_region(region_name):
     '''Find id of vpc in a given region. The id may differ for different regions'''
 
-    ec2 = boto3.resource('ec2', region_name)
+    ec2 = ec2_resource(region_name)
     vpcs_ids = []
     for vpc in ec2.vpcs.all():
         if vpc.is_default:
@@ -39,111 +205,214 @@ def vpc_id_in_region(region_name):
     return vpcs_ids[0]
 
 
-def create_security_group(region_name, ip_list=[], tag=''):
+@traced('ec2')
+def security_group_by_name(region_name, tag=''):
+    '''Returns the description of the security group of a given tag or None if it does not exist.'''
+
+    groups = ec2_client(region_name).describe_security_groups(
+        Filters=[{'Name': 'group-name', 'Values': ['aleph-' + tag]}])['SecurityGroups']
+
+    return groups[0] if groups else None
+
+
+@traced('ec2')
+def create_security_group(region_name, ip_list=[], tag='', vpc_id=None):
     '''Creates security group that allows connecting via ssh and ports needed for sync'''
 
     security_group_name = 'aleph-' + tag
 
-    ec2 = boto3.resource('ec2', region_name)
+    ec2 = ec2_resource(region_name)
 
     # get the id of vpc in the given region
-    vpc_id = vpc_id_in_region(region_name)
+    vpc_id = vpc_id or vpc_id_in_region(region_name)
     sg = ec2.create_security_group(
         GroupName=security_group_name, Description='full sync', VpcId=vpc_id)
 
-    # authorize incomming connections to port 22 for ssh
-    sg.authorize_ingress(
-        GroupName=security_group_name,
-        IpPermissions=[
-            {
-                'FromPort': 22,
-                'IpProtocol': 'tcp',
-                'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
-                'ToPort': 22,
-            },
-            {
-                'FromPort': 0,
-                'IpProtocol': '-1',
-                'IpRanges': [{'CidrIp': f'{ip}/32'} for ip in ip_list],
-                'ToPort': 65535,
-            },
-        ]
-    )
+    # describing the group right after creating it may not find it yet, a new group has no ingress rules
+    sync_security_group(region_name, ip_list, tag, sg={'GroupId': sg.id, 'IpPermissions': []})
 
     return sg
 
 
-def allow_all_traffic_in_region(region_name, tag=''):
-    security_group_name = 'aleph-' + tag
+def _ingress_rules(ip_permissions):
+    '''
+    Flattens ip permissions into a set of rules (protocol, from port, to port, kind, value), where
+    kind is 'cidr' or 'prefix'. Ports are ignored for all-traffic permissions, as aws drops them.
+    '''
+
+    rules = set()
+    for perm in ip_permissions:
+        protocol = perm['IpProtocol']
+        ports = (None, None) if protocol == '-1' else (perm.get('FromPort'), perm.get('ToPort'))
+        for ip_range in perm.get('IpRanges', []):
+            rules.add((protocol, *ports, 'cidr', ip_range['CidrIp']))
+        for prefix_list in perm.get('PrefixListIds', []):
+            rules.add((protocol, *ports, 'prefix', prefix_list['PrefixListId']))
+
+    return rules
 
-    ec2 = boto3.resource('ec2', region_name)
 
-    for security_group in ec2.security_groups.all():
-        if security_group.group_name != security_group_name:
-            continue
+def _ip_permissions(rules):
+    '''Inverse of _ingress_rules, groups rules with the same protocol and ports into one permission.'''
 
-        security_group.revoke_ingress(
-            IpPermissions=security_group.ip_permissions)
-        security_group.authorize_ingress(
-            GroupName=security_group_name,
-            IpPermissions=[
-                {
-                    'FromPort': 0,
-                    'IpProtocol': '-1',
-                    'IpRanges': [{'CidrIp': f'0.0.0.0/0'}],
-                    'ToPort': 65535,
-                },
-            ]
-        )
+    perms = {}
+    for protocol, from_port, to_port, kind, value in sorted(rules, key=str):
+        perm = perms.get((protocol, from_port, to_port))
+        if perm is None:
+            perm = {'IpProtocol': protocol, 'IpRanges': [], 'PrefixListIds': []}
+            if from_port is not None:
+                perm.update(FromPort=from_port, ToPort=to_port)
+            perms[(protocol, from_port, to_port)] = perm
+        if kind == 'cidr':
+            perm['IpRanges'].append({'CidrIp': value})
+        else:
+            perm['PrefixListIds'].append({'PrefixListId': value})
 
-        return security_group
+    return list(perms.values())
+
+
+def _quota_usage(client, rules):
+    '''Number of rules counted against the quota of a group, a referenced prefix list counts with its max entries.'''
+
+    pl_ids = sorted({value for _, _, _, kind, value in rules if kind == 'prefix'})
+    pls = client.describe_managed_prefix_lists(PrefixListIds=pl_ids)['PrefixLists'] if pl_ids else []
+
+    return sum(kind == 'cidr' for _, _, _, kind, _ in rules) + sum(pl['MaxEntries'] for pl in pls)
+
+
+def _wait_prefix_list(client, prefix_list_id):
+    '''Waits until pending changes of a prefix list are applied and returns its description.'''
+
+    while True:
+        pl = client.describe_managed_prefix_lists(
+            PrefixListIds=[prefix_list_id])['PrefixLists'][0]
+        if pl['State'].endswith('-failed'):
+            raise Exception(f'prefix list {prefix_list_id}: {pl.get("StateMessage", pl["State"])}')
+        if pl['State'].endswith('-complete'):
+            return pl
+        sleep(1)
+
+
+@traced('ec2')
+def sync_prefix_list(region_name, ip_list, tag=''):
+    '''
+    Makes the managed prefix list of a given tag contain exactly /32 ranges of ips from ip_list,
+    creating it if needed. Only missing entries are added and only stale ones are removed.
+    :returns: id of the prefix list
+    '''
+
+    client = ec2_client(region_name)
+    name = 'aleph-' + tag
+    wanted = {f'{ip}/32' for ip in ip_list}
+
+    pls = client.describe_managed_prefix_lists(
+        Filters=[{'Name': 'prefix-list-name', 'Values': [name]}])['PrefixLists']
+    if pls:
+        pl = _wait_prefix_list(client, pls[0]['PrefixListId'])
+    else:
+        pl = client.create_managed_prefix_list(
+            PrefixListName=name, AddressFamily='IPv4',
+            MaxEntries=max(1, len(wanted)))['PrefixList']
+        pl = _wait_prefix_list(client, pl['PrefixListId'])
+
+    pl_id = pl['PrefixListId']
+    current = set()
+    paginator = client.get_paginator('get_managed_prefix_list_entries')
+    for page in paginator.paginate(PrefixListId=pl_id):
+        current.update(entry['Cidr'] for entry in page['Entries'])
+
+    if len(wanted) > pl['MaxEntries']:
+        client.modify_managed_prefix_list(
+            PrefixListId=pl_id, CurrentVersion=pl['Version'], MaxEntries=len(wanted))
+        pl = _wait_prefix_list(client, pl_id)
+
+    # aws accepts at most 100 added and 100 removed entries per modification
+    to_add, to_remove = sorted(wanted - current), sorted(current - wanted)
+    while to_add or to_remove:
+        client.modify_managed_prefix_list(
+            PrefixListId=pl_id, CurrentVersion=pl['Version'],
+            AddEntries=[{'Cidr': cidr} for cidr in to_add[:100]],
+            RemoveEntries=[{'Cidr': cidr} for cidr in to_remove[:100]])
+        to_add, to_remove = to_add[100:], to_remove[100:]
+        pl = _wait_prefix_list(client, pl_id)
+
+    # unused capacity would still count against the rules quota of the group
+    if pl['MaxEntries'] > max(1, len(wanted)):
+        client.modify_managed_prefix_list(
+            PrefixListId=pl_id, CurrentVersion=pl['Version'], MaxEntries=max(1, len(wanted)))
+        _wait_prefix_list(client, pl_id)
+
+    return pl_id
+
+
+@traced('ec2')
+def sync_security_group(region_name, ip_list=[], tag='', allow_all=False, sg=None):
+    '''
+    Makes the security group of a given tag allow ssh from anywhere and all traffic from ips in
+    ip_list (or from anywhere if allow_all is set). Only the difference between the current and the
+    wanted rules is sent, and new rules are authorized before stale ones are revoked, so existing
+    traffic is never dropped. More than PREFIX_LIST_THRESHOLD ips are kept in a managed prefix list,
+    which is referenced by a single rule. As the list counts against the rules quota with all its
+    entries, stale rules are revoked first only if keeping them next to the new ones would exceed
+    SECURITY_GROUP_RULES_QUOTA.
+    :param dict sg: description of the group (GroupId and IpPermissions), looked up by tag by default
+    :returns: the security group
+    '''
+
+    sg = sg or security_group_by_name(region_name, tag)
+    if sg is None:
+        return None if allow_all else create_security_group(region_name, ip_list, tag)
+
+    if allow_all:
+        wanted = {('-1', None, None, 'cidr', '0.0.0.0/0')}
+    else:
+        wanted = {('tcp', 22, 22, 'cidr', '0.0.0.0/0')}
+        if len(ip_list) > PREFIX_LIST_THRESHOLD:
+            pl_id = sync_prefix_list(region_name, ip_list, tag)
+            wanted.add(('-1', None, None, 'prefix', pl_id))
+        else:
+            wanted.update(('-1', None, None, 'cidr', f'{ip}/32') for ip in ip_list)
+
+    current = _ingress_rules(sg['IpPermissions'])
+    client = ec2_client(region_name)
+    # authorizing first keeps traffic flowing, unless old and new rules together do not fit in the quota
+    revoke_first = bool(current - wanted) and \
+        _quota_usage(client, current | wanted) > SECURITY_GROUP_RULES_QUOTA
+    if revoke_first:
+        client.revoke_security_group_ingress(
+            GroupId=sg['GroupId'], IpPermissions=_ip_permissions(current - wanted))
+    if wanted - current:
+        client.authorize_security_group_ingress(
+            GroupId=sg['GroupId'], IpPermissions=_ip_permissions(wanted - current))
+    if not revoke_first and current - wanted:
+        client.revoke_security_group_ingress(
+            GroupId=sg['GroupId'], IpPermissions=_ip_permissions(current - wanted))
+
+    return ec2_resource(region_name).SecurityGroup(sg['GroupId'])
+
+
+def allow_all_traffic_in_region(region_name, tag=''):
+    if security_group_by_name(region_name, tag) is None:
+        return None
+
+    return sync_security_group(region_name, tag=tag, allow_all=True)
 
 
 def update_security_group(region_name, ip_list=[], tag=''):
-    '''Creates security group that allows connecting via ssh and ports needed for sync'''
+    '''Makes security group allow connecting via ssh and ports needed for sync'''
 
-    security_group_name = 'aleph-' + tag
+    if security_group_by_name(region_name, tag) is None:
+        return None
 
-    ec2 = boto3.resource('ec2', region_name)
-
-    for security_group in ec2.security_groups.all():
-        if security_group.group_name == security_group_name:
-            security_group.revoke_ingress(
-                IpPermissions=security_group.ip_permissions)
-
-            # authorize incomming connections to port 22 for ssh and
-            # all traffic from the given addresses
-            security_group.authorize_ingress(
-                GroupName=security_group_name,
-                IpPermissions=[
-                    {
-                        'FromPort': 22,
-                        'IpProtocol': 'tcp',
-                        'IpRanges': [{'CidrIp': '0.0.0.0/0'}],
-                        'ToPort': 22,
-                    },
-                    {
-                        'FromPort': 0,
-                        'IpProtocol': '-1',
-                        'IpRanges': [{'CidrIp': f'{ip}/32'} for ip in ip_list],
-                        'ToPort': 65535,
-                    },
-                ]
-            )
-
-            return security_group
+    return sync_security_group(region_name, ip_list, tag)
 
 
 def security_group_id_by_region(region_name, tag=''):
     '''Finds id of a security group. It may differ for different regions'''
 
-    security_group_name = 'aleph-' + tag
-
-    ec2 = boto3.resource('ec2', region_name)
-    security_groups = ec2.security_groups.all()
-    for security_group in security_groups:
-        if security_group.group_name == security_group_name:
-            return security_group.id
+    sg = security_group_by_name(region_name, tag)
+    if sg is not None:
+        return sg['GroupId']
 
     # it seems that the group does not exist, let fix that
     return create_security_group(region_name, tag=tag).id
@@ -163,7 +432,7 @@ def check_key_uploaded_all_regions(key_name='aleph'):
         fp = f.readline()
 
     for region_name in use_regions():
-        ec2 = boto3.resource('ec2', region_name)
+        ec2 = ec2_resource(region_name)
         # check if there is any key which fingerprint matches fp
         if not any(key.key_fingerprint == fp for key in ec2.key_pairs.all()):
             return False
@@ -171,6 +440,7 @@ def check_key_uploaded_all_regions(key_name='aleph'):
     return True
 
 
+@traced('ec2')
 def generate_key_pair_all_regions(key_name='aleph'):
     '''Generates key pair, stores private key locally, and sends public key to all regions'''
 
@@ -196,7 +466,7 @@ def generate_key_pair_all_regions(key_name='aleph'):
     # we need to send it there at least once
     wrote_fp = False
     for region_name in use_regions():
-        ec2 = boto3.resource('ec2', region_name)
+        ec2 = ec2_resource(region_name)
         # first delete the old key
         for key in ec2.key_pairs.all():
             if key.name == key_name:
@@ -215,6 +485,7 @@ def generate_key_pair_all_regions(key_name='aleph'):
             wrote_fp = True
 
 
+@traced('ec2')
 def init_key_pair(region_name, key_name='aleph', dry_run=False):
     ''' Initializes key pair needed for using instances.'''
 
@@ -226,7 +497,7 @@ def init_key_pair(region_name, key_name='aleph', dry_run=False):
 
         if not dry_run:
             print('found local key; ', end='')
-        ec2 = boto3.resource('ec2', region_name)
+        ec2 = ec2_resource(region_name)
         with open(fingerprint_path, 'r') as f:
             fp = f.readline()
 
@@ -257,6 +528,50 @@ def init_key_pair(region_name, key_name='aleph', dry_run=False):
         generate_key_pair_all_regions(key_name)
 
 
+def ensure_local_key_pair(key_name='aleph'):
+    '''
+    Generates the key pair and uploads it to all regions if there is no local one. Meant to run
+    once before regions are provisioned concurrently, so that they never race to generate it.
+    '''
+
+    key_path = f'key_pairs/{key_name}.pem'
+    fingerprint_path = f'key_pairs/{key_name}.fingerprint'
+
+    if not (os.path.exists(key_path) and os.path.exists(fingerprint_path)):
+        generate_key_pair_all_regions(key_name)
+
+
+@contextmanager
+def file_lock(path):
+    ''' Exclusive lock guarding a file shared by threads and processes (e.g. joblib workers).'''
+
+    with open(path + '.lock', 'w') as lock_file:
+        fcntl.flock(lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def read_json(path, default=None):
+    ''' Reads a json file, returns default if it does not exist or is corrupted.'''
+
+    try:
+        with open(path, 'r') as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return default
+
+
+def write_json_atomic(path, data):
+    ''' Writes a json file so that readers never see it half-written.'''
+
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+
+
 def read_aws_keys():
     ''' Reads access and secret access keys needed for connecting to aws.'''
 
@@ -270,45 +585,155 @@ def read_aws_keys():
 
 
 def generate_account():
-    ''' Generate secret phrase and account id for a validator.'''
-    cmd = './bin/aleph-node key generate --output-type json --words 24'
-    jsons = run(cmd.split(), capture_output=True)
-    creds = json.loads(jsons.stdout)
-    phrase = creds['secretPhrase']
-    account_id = creds['ss58PublicKey']
+    '''
+    Generate secret phrase and account id for a validator, the same as
+    `aleph-node key generate --words 24` does (sr25519, generic ss58 format), without spawning it.
+    '''
+    from bip_utils import Bip39MnemonicGenerator, Bip39WordsNum, Substrate, SubstrateBip39SeedGenerator, SubstrateCoins
+
+    phrase = Bip39MnemonicGenerator().FromWordsNumber(Bip39WordsNum.WORDS_NUM_24).ToStr()
+    seed = SubstrateBip39SeedGenerator(phrase).Generate()
+    account_id = Substrate.FromSeed(seed, SubstrateCoins.GENERIC).PublicKey().ToAddress()
 
     return phrase, account_id
 
 
+def generate_account_batch(n):
+    return [generate_account() for _ in range(n)]
+
+
+@traced('local')
 def generate_accounts(n_parties, chain, phrases_path, account_ids_path):
-    ''' Generate secret phrases and account ids for the committee.'''
+    '''
+    Generate secret phrases and account ids for the committee. More than ACCOUNT_BATCH accounts
+    are generated in a pool of processes, both files are written at once at the end.
+    '''
 
     if chain == 'dev':
         return [str(i) for i in range(n_parties)]
 
-    phrases_account_ids = [generate_account() for _ in range(n_parties)]
+    if n_parties <= ACCOUNT_BATCH:
+        phrases_account_ids = generate_account_batch(n_parties)
+    else:
+        from joblib import Parallel, delayed
+
+        batches = [min(ACCOUNT_BATCH, n_parties - i) for i in range(0, n_parties, ACCOUNT_BATCH)]
+        phrases_account_ids = [account for batch in Parallel(n_jobs=ACCOUNT_JOBS)(
+            delayed(generate_account_batch)(n) for n in batches) for account in batch]
     phrases, account_ids = list(zip(*phrases_account_ids))
 
     with open(phrases_path, 'w') as f:
-        f.writelines([p+'\n' for p in phrases])
+        f.write(''.join(p+'\n' for p in phrases))
 
     with open(account_ids_path, 'w') as f:
-        f.writelines([a+'\n' for a in account_ids])
+        f.write(''.join(a+'\n' for a in account_ids))
 
     return account_ids
 
 
 def derive_account_from_seed(seed, path):
+    from bip_utils import SubstrateCoins, Substrate
+
     substrate_ctx = Substrate.FromSeedAndPath(seed, f'//{path}', SubstrateCoins.GENERIC)
     return substrate_ctx.PublicKey().ToAddress()
 
 
 def generate_accounts_from_paths(paths):
-    seed_bytes = SubstrateBip39SeedGenerator("bottom drive obey lake curtain smoke basket hold race lonely fit walk").Generate()
+    from bip_utils import SubstrateBip39SeedGenerator
+
+    seed_bytes = SubstrateBip39SeedGenerator(BENCHMARK_PHRASE).Generate()
 
     return (derive_account_from_seed(seed_bytes, path) for path in paths)
 
 
+def derive_public_keys(phrase, start, stop):
+    ''' Returns concatenated public keys of accounts //start, ..., //(stop-1) derived from a phrase.'''
+    from bip_utils import Substrate, SubstrateBip39SeedGenerator, SubstrateCoins
+
+    ctx = Substrate.FromSeed(SubstrateBip39SeedGenerator(phrase).Generate(), SubstrateCoins.GENERIC)
+
+    return b''.join(ctx.DerivePath(f'//{i}').PublicKey().RawCompressed().ToBytes() for i in range(start, stop))
+
+
+def derivation_cache_path(phrase):
+    ''' Cache of accounts derived from a phrase, named by its hash so the phrase itself is not written down.'''
+
+    return os.path.join(DERIVATION_CACHE_DIR, hashlib.sha256(phrase.encode()).hexdigest()[:32] + '.bin')
+
+
+@traced('local')
+def derive_accounts(n_accounts, phrase=BENCHMARK_PHRASE, start=0, n_jobs=ACCOUNT_JOBS):
+    '''
+    Returns ids of accounts //start, ..., //(start+n_accounts-1) derived from a phrase. Accounts from //0
+    on are cached, so only the ones past the cached prefix are derived: in shards of DERIVATION_SHARD
+    accounts over a pool of processes, DERIVATION_ROUND shards at a time. Every round is appended to
+    the cache once it completes, so an interrupted run keeps the rounds it finished.
+    '''
+
+    from bip_utils import SS58Encoder
+
+    stop = start + n_accounts
+    path = derivation_cache_path(phrase)
+    os.makedirs(DERIVATION_CACHE_DIR, exist_ok=True)
+    with file_lock(path):
+        with open(path, 'ab+') as f:
+            # a shard written partially by an interrupted run is dropped
+            cached = f.tell() // 32
+            f.truncate(cached * 32)
+            if cached < stop:
+                shards = [(i, min(i + DERIVATION_SHARD, stop)) for i in range(cached, stop, DERIVATION_SHARD)]
+                if len(shards) == 1:
+                    f.write(derive_public_keys(phrase, *shards[0]))
+                else:
+                    from joblib import Parallel, delayed
+
+                    with Parallel(n_jobs=n_jobs) as parallel:
+                        for i in range(0, len(shards), DERIVATION_ROUND):
+                            keys = parallel(delayed(derive_public_keys)(phrase, *shard)
+                                            for shard in shards[i:i + DERIVATION_ROUND])
+                            f.write(b''.join(keys))
+                            f.flush()
+            f.seek(start * 32)
+            keys = f.read(n_accounts * 32)
+
+    return [SS58Encoder.Encode(keys[i:i + 32], SS58_FORMAT)
+            for i in range(0, len(keys), 32)]
+
+
+def run_for_accounts(name, account_ids, cmd_of, max_workers=BOOTSTRAP_WORKERS):
+    '''
+    Runs a command for every account in a bounded pool and prints how long it took per account.
+    :param function cmd_of: maps an account id to the command to run for it
+    :returns: list of CompletedProcess in the order of account_ids
+    '''
+
+    def run_one(account_id):
+        start = time()
+        res = run(cmd_of(account_id), capture_output=True)
+        end = time()
+        record(name, start, end, 'local', account=account_id, exit_status=res.returncode)
+        return res, end - start
+
+    start = time()
+    with ThreadPoolExecutor(max_workers=max(1, min(len(account_ids), max_workers))) as pool:
+        results = list(pool.map(run_one, account_ids))
+    if not results:
+        return []
+
+    failed = [(account_id, res) for account_id, (res, _) in zip(account_ids, results) if res.returncode != 0]
+    if failed:
+        account_id, res = failed[0]
+        raise RuntimeError(f'{name} failed for {len(failed)} accounts, e.g. {account_id}: '
+                           f'{res.stderr.decode(errors="replace").strip()}')
+
+    took = sorted((took, account_id) for account_id, (_, took) in zip(account_ids, results))
+    print(f'{name}: {len(took)} accounts in {time() - start:.2f}s, per account min {took[0][0]:.2f}s '
+          f'p50 {took[len(took) // 2][0]:.2f}s max {took[-1][0]:.2f}s ({took[-1][1]})')
+
+    return [res for res, _ in results]
+
+
+@traced('local')
 def bootstrap_nodes(account_ids, chain, **custom_flags):
     ''' Create keys for a node. '''
 
@@ -326,9 +751,9 @@ def bootstrap_nodes(account_ids, chain, **custom_flags):
         for (flag, value) in flags.items():
             cmd += [f'{flag}', f'{value}']
 
-    for account_id in account_ids:
-        run(cmd + ['--account-id', f'{account_id}'])
+    run_for_accounts('bootstrap-node', account_ids, lambda account_id: cmd + ['--account-id', f'{account_id}'])
 
+@traced('local')
 def bootstrap_chain(account_ids, chain, benchmark_config=None, rich_accounts=[], **custom_flags):
     ''' Create the chain spec. '''
 
@@ -399,11 +824,12 @@ def prepare_vesting(chainspec):
     rtm['vesting']['vesting'] = vesting
 
 
+@traced('local')
 def prepare_benchmark_accounts(chainspec, n_of_accounts, azero_amount):
     n_of_accounts = int(n_of_accounts)
     azero_amount = int(azero_amount)
 
-    bench_accounts = generate_accounts_from_paths((str(i) for i in range(n_of_accounts)))
+    bench_accounts = derive_accounts(n_of_accounts)
     amount = azero_amount * azero()
     balances = ((aid, amount) for aid in bench_accounts)
 
@@ -411,15 +837,14 @@ def prepare_benchmark_accounts(chainspec, n_of_accounts, azero_amount):
     rtm['balances']['balances'] += list(balances)
 
 
+@traced('local')
 def generate_p2p_keys(account_ids):
-    pks = ""
-    for auth in account_ids:
-        cmd = f'./bin/aleph-node key generate-node-key --file data/{auth}/p2p_secret'
-        pk = run(cmd.split(), capture_output=True)
-        pks += pk.stderr[:-1].decode() + '\n'
+    results = run_for_accounts('generate-node-key', account_ids, lambda auth: [
+        './bin/aleph-node', 'key', 'generate-node-key', '--file', f'data/{auth}/p2p_secret'])
 
+    # the peer id is printed on stderr
     with open('libp2p_public_keys', 'w') as f:
-        f.write(pks)
+        f.write(''.join(res.stderr.decode().strip() + '\n' for res in results))
 
 
 def write_addresses(ip_list):
@@ -447,19 +872,52 @@ def testnet_bootnodes():
 def default_region():
     ''' Helper function for getting default region name for current setup.'''
 
-    return boto3.Session().region_name
+    return aws_session().region_name
+
+
+@traced('ec2')
+def describe_tagged_instances(region_name, tag='dev', states=('running', 'pending')):
+    '''
+    Returns an InstanceRecord for every instance in a given region that is tagged net=tag and is
+    in one of given states. Filtering is done by aws, so instances of other users are never paged
+    through. For an empty tag, only instances without any tags are returned.
+    '''
+
+    filters = [{'Name': 'instance-state-name', 'Values': list(states)}]
+    if tag:
+        filters.append({'Name': 'tag:net', 'Values': [tag]})
+
+    paginator = ec2_client(region_name).get_paginator('describe_instances')
+    records = []
+    for page in paginator.paginate(Filters=filters, PaginationConfig={'PageSize': 1000}):
+        for reservation in page['Reservations']:
+            for instance in reservation['Instances']:
+                if not tag and instance.get('Tags'):
+                    continue
+                records.append(InstanceRecord(
+                    instance['InstanceId'],
+                    region_name,
+                    instance.get('PublicIpAddress'),
+                    instance.get('PrivateIpAddress'),
+                    instance['State']['Name'],
+                    instance['Placement']['AvailabilityZone'],
+                ))
+
+    return records
 
 
 def describe_instances(region_name):
     ''' Prints launch indexes and state of all instances in a given region.'''
 
-    ec2 = boto3.resource('ec2', region_name)
+    ec2 = ec2_resource(region_name)
     for instance in ec2.instances.all():
         print(
             f'ami_launch_index={instance.ami_launch_index} state={instance.state}')
 
 
-def n_parties_per_regions(n_parties, regions=use_regions()):
+def n_parties_per_regions(n_parties, regions=None):
+    regions = use_regions() if regions is None else regions
+
     nhpr = {}
     n_left = n_parties
     for r in regions: